@@ -7,10 +7,13 @@ Purpose: Python CLI wrapper for launching Nextflow pipelines on Cloud Batch
 Usage:
     python run_pipeline.py qc --sample HG00119
     python run_pipeline.py variant-calling --bam gs://bucket/sample.bam
+    python run_pipeline.py full --samples cohort.tsv --max-concurrent 8
 =============================================================================
 """
 
 import argparse
+import asyncio
+import functools
 import os
 import subprocess
 import sys
@@ -23,31 +26,43 @@ from typing import Optional
 SCRIPT_DIR = Path(__file__).parent
 PIPELINES_DIR = SCRIPT_DIR.parent / "pipelines"
 DEFAULT_PROFILE = "gcp"
+# One Nextflow launch dir (.nextflow/, work/, nextflow.out) per cohort sample,
+# kept outside the source tree and stable across runs for -resume
+LAUNCH_DIR = Path(os.environ.get("NEXTFLOW_LAUNCH_DIR", Path.home() / ".cache" / "multiomics-nextflow"))
+N_CONCURRENT = 4
 
 
+@functools.lru_cache(maxsize=1)
 def get_project_id() -> str:
-    """Get current GCP project ID."""
+    """Get current GCP project ID from the environment or gcloud config."""
+    # Set in Cloud Shell and most Google-managed runtimes; avoids forking gcloud
+    project_id = os.environ.get("GOOGLE_CLOUD_PROJECT") or os.environ.get("GCP_PROJECT")
+    if project_id:
+        return project_id
     result = subprocess.run(
         ["gcloud", "config", "get-value", "project"],
+        stdin=subprocess.DEVNULL,
         capture_output=True,
         text=True,
     )
     return result.stdout.strip()
 
 
-def run_nextflow(
+def _timestamp() -> str:
+    """Wall-clock prefix for relayed Nextflow output."""
+    return datetime.now().strftime("%H:%M:%S")
+
+
+def build_nextflow_command(
     workflow: str,
     params: dict,
-    profile: str = DEFAULT_PROFILE,
-    resume: bool = False,
-    work_dir: Optional[str] = None,
-    dry_run: bool = False,
-) -> int:
-    """Run a Nextflow pipeline."""
-    
-    project_id = get_project_id()
-    
-    # Build command
+    profile: str,
+    resume: bool,
+    work_dir: Optional[str],
+    project_id: str,
+    timestamp: str,
+) -> list[str]:
+    """Build the `nextflow run` command line for a workflow."""
     cmd = [
         "nextflow", "run",
         str(PIPELINES_DIR / "main.nf"),
@@ -70,10 +85,26 @@ def run_nextflow(
         cmd.extend(["-work-dir", f"gs://{project_id}-multiomics-staging-dev/work"])
     
     # Add timestamp to output
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     if "outdir" not in params:
         cmd.extend(["--outdir", f"gs://{project_id}-multiomics-results-dev/{workflow}/{timestamp}"])
     
+    return cmd
+
+
+def run_nextflow(
+    workflow: str,
+    params: dict,
+    profile: str = DEFAULT_PROFILE,
+    resume: bool = False,
+    work_dir: Optional[str] = None,
+    dry_run: bool = False,
+) -> int:
+    """Run a Nextflow pipeline."""
+    
+    project_id = get_project_id()
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    cmd = build_nextflow_command(workflow, params, profile, resume, work_dir, project_id, timestamp)
+    
     print("=" * 70)
     print(f"Running Nextflow Pipeline: {workflow}")
     print("=" * 70)
@@ -84,10 +115,107 @@ def run_nextflow(
         print("[DRY RUN] Command not executed.")
         return 0
     
-    # Execute
+    # Execute, relaying Nextflow's output line by line with timestamps
     os.chdir(PIPELINES_DIR)
-    result = subprocess.run(cmd)
-    return result.returncode
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1,
+    )
+    for line in proc.stdout:
+        sys.stdout.write(f"[{_timestamp()}] {line}")
+    return proc.wait()
+
+
+async def _run_nextflow(sample_id: str, cmd: list[str], semaphore: asyncio.Semaphore) -> int:
+    """Run one sample's Nextflow process in its own launch dir.
+
+    Output is multiplexed onto stdout with a timestamp and sample prefix, and
+    the raw output is also kept in the launch dir's nextflow.out.
+    """
+    # Concurrent runs cannot share a launch dir: each holds a lock on .nextflow/
+    launch_dir = LAUNCH_DIR / sample_id
+    launch_dir.mkdir(parents=True, exist_ok=True)
+    async with semaphore:
+        print(f"[{_timestamp()}] [{sample_id}] started (log: {launch_dir / 'nextflow.out'})")
+        with open(launch_dir / "nextflow.out", "wb") as log:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, cwd=launch_dir, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+            )
+            async for line in proc.stdout:
+                log.write(line)
+                sys.stdout.write(f"[{_timestamp()}] [{sample_id}] {line.decode(errors='replace')}")
+            returncode = await proc.wait()
+    print(f"[{_timestamp()}] [{sample_id}] {'completed' if returncode == 0 else f'failed (exit {returncode})'}")
+    return returncode
+
+
+def read_samples(path: str) -> list[tuple[str, str]]:
+    """Read `sample_id<whitespace>bam_path` lines, skipping blanks and # comments."""
+    samples = []
+    seen = {}
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            fields = line.split()
+            if len(fields) != 2:
+                raise ValueError(f"{path}:{line_no}: expected 'sample_id bam_path', got {line!r}")
+            # Each sample gets its own LAUNCH_DIR subdirectory
+            if "/" in fields[0] or "\\" in fields[0] or fields[0] in (".", ".."):
+                raise ValueError(f"{path}:{line_no}: sample_id {fields[0]!r} is not a plain name")
+            if fields[0] in seen:
+                raise ValueError(f"{path}:{line_no}: duplicate sample_id {fields[0]!r} (first on line {seen[fields[0]]})")
+            seen[fields[0]] = line_no
+            samples.append((fields[0], fields[1]))
+    return samples
+
+
+def run_nextflow_cohort(
+    workflow: str,
+    samples: list[tuple[str, str]],
+    base_params: dict,
+    outdir: Optional[str],
+    profile: str = DEFAULT_PROFILE,
+    resume: bool = False,
+    max_concurrent: int = N_CONCURRENT,
+    dry_run: bool = False,
+) -> int:
+    """Run a workflow for many samples as concurrent Nextflow processes."""
+    project_id = get_project_id()
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    outdir = outdir or f"gs://{project_id}-multiomics-results-dev/{workflow}/{timestamp}"
+    
+    commands = {}
+    for sample_id, bam in samples:
+        params = {**base_params, "sample_id": sample_id, "input_bam": bam,
+                  "outdir": f"{outdir.rstrip('/')}/{sample_id}"}
+        commands[sample_id] = build_nextflow_command(
+            workflow, params, profile, resume, None, project_id, timestamp)
+    
+    print("=" * 70)
+    print(f"Running Nextflow Pipeline: {workflow} for {len(commands)} samples "
+          f"({max_concurrent} at a time)")
+    print("=" * 70)
+    
+    if dry_run:
+        for sample_id, cmd in commands.items():
+            print(f"[{sample_id}] {' '.join(cmd)}")
+        print("[DRY RUN] Commands not executed.")
+        return 0
+    
+    async def run_all():
+        semaphore = asyncio.Semaphore(max_concurrent)
+        return await asyncio.gather(*(
+            _run_nextflow(sample_id, cmd, semaphore) for sample_id, cmd in commands.items()
+        ))
+    
+    returncodes = asyncio.run(run_all())
+    failed = [s for s, rc in zip(commands, returncodes) if rc != 0]
+    print("=" * 70)
+    print(f"{len(commands) - len(failed)}/{len(commands)} samples completed")
+    if failed:
+        print(f"Failed: {', '.join(failed)}")
+    return 1 if failed else 0
 
 
 def cmd_qc(args):
@@ -126,6 +254,22 @@ def cmd_variant_calling(args):
 
 def cmd_full(args):
     """Run full pipeline (QC + variant calling)."""
+    if args.samples:
+        return run_nextflow_cohort(
+            workflow="main",
+            samples=read_samples(args.samples),
+            base_params={
+                "reference": args.reference,
+                "skip_qc": False,
+                "run_variant_calling": True,
+            },
+            outdir=args.output,
+            profile=args.profile,
+            resume=args.resume,
+            max_concurrent=args.max_concurrent,
+            dry_run=args.dry_run,
+        )
+    
     params = {
         "sample_id": args.sample,
         "input_bam": args.bam,
@@ -187,10 +331,15 @@ def main():
     
     # Full pipeline subcommand
     full_parser = subparsers.add_parser("full", help="Run complete pipeline (QC + variant calling)")
-    full_parser.add_argument("--sample", "-s", required=True, help="Sample ID")
-    full_parser.add_argument("--bam", "-b", required=True, help="Input BAM file (GCS path)")
+    full_parser.add_argument("--sample", "-s", help="Sample ID")
+    full_parser.add_argument("--bam", "-b", help="Input BAM file (GCS path)")
+    full_parser.add_argument("--samples", help="File of 'sample_id bam_path' lines to run as a cohort "
+                                               "(instead of --sample/--bam)")
+    full_parser.add_argument("--max-concurrent", type=int, default=N_CONCURRENT,
+                             help=f"Cohort samples to run at once (default: {N_CONCURRENT})")
     full_parser.add_argument("--reference", help="Reference genome (GCS path)")
-    full_parser.add_argument("--output", "-o", help="Output directory (GCS path)")
+    full_parser.add_argument("--output", "-o", help="Output directory (GCS path; per-sample "
+                                                    "subdirectories with --samples)")
     full_parser.set_defaults(func=cmd_full)
     
     args = parser.parse_args()
@@ -199,6 +348,11 @@ def main():
         parser.print_help()
         sys.exit(1)
     
+    if args.command == "full" and not args.samples and not (args.sample and args.bam):
+        full_parser.error("either --samples or both --sample and --bam are required")
+    if args.command == "full" and args.max_concurrent < 1:
+        full_parser.error("--max-concurrent must be at least 1")
+    
     sys.exit(args.func(args))
 
 
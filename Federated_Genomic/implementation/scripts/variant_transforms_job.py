@@ -10,6 +10,9 @@ Usage:
 """
 
 import argparse
+import functools
+import os
+import shlex
 import subprocess
 import sys
 from datetime import datetime
@@ -32,10 +35,16 @@ DEFAULTS = {
 VT_IMAGE = "gcr.io/cloud-lifesciences/gcp-variant-transforms"
 
 
+@functools.lru_cache(maxsize=1)
 def get_project_id() -> str:
-    """Get the current GCP project ID from gcloud config."""
+    """Get the current GCP project ID from the environment or gcloud config."""
+    # Set in Cloud Shell and most Google-managed runtimes; avoids forking gcloud
+    project_id = os.environ.get("GOOGLE_CLOUD_PROJECT") or os.environ.get("GCP_PROJECT")
+    if project_id:
+        return project_id
     result = subprocess.run(
         ["gcloud", "config", "get-value", "project"],
+        stdin=subprocess.DEVNULL,
         capture_output=True,
         text=True,
         check=True,
@@ -57,15 +66,12 @@ def build_variant_transforms_command(
 ) -> list[str]:
     """Build the Variant Transforms command."""
     
-    # Base command
     cmd = [
-        "docker", "run", "-v", "/tmp:/tmp",
+        # Base command: remove the container on exit; reuse the cached image
+        "docker", "run", "--rm", "--pull=missing", "-v", "/tmp:/tmp",
         VT_IMAGE,
         "/opt/gcp_variant_transforms/bin/vcf_to_bq",
-    ]
-    
-    # Required arguments
-    cmd.extend([
+        # Required arguments
         "--project", project,
         "--input_pattern", vcf_path,
         "--output_table", f"{project}:{dataset}.{table}",
@@ -73,25 +79,15 @@ def build_variant_transforms_command(
         "--job_name", f"vcf-to-bq-{datetime.now().strftime('%Y%m%d-%H%M%S')}",
         "--runner", "DataflowRunner",
         "--region", region,
-    ])
-    
-    # Performance tuning
-    cmd.extend([
+        # Performance tuning
         "--worker_machine_type", machine_type,
         "--max_num_workers", str(max_workers),
         "--worker_disk_type", "compute.googleapis.com/projects//zones//diskTypes/pd-ssd",
-    ])
-    
-    # Schema options
-    cmd.extend([
+        # Schema options
         "--sample_name_encoding", "without_sample_name",  # For single-sample VCFs
-    ])
-    
-    if append:
-        cmd.append("--append")
-    
-    if representative_header:
-        cmd.extend(["--representative_header_file", representative_header])
+        *(["--append"] if append else []),
+        *(["--representative_header_file", representative_header] if representative_header else []),
+    ]
     
     return cmd
 
@@ -144,7 +140,7 @@ def run_variant_transforms(
     )
     
     print("\nCommand:")
-    print(" ".join(cmd))
+    print(shlex.join(cmd))  # shell-safe, so it can be pasted back as-is
     print()
     
     if dry_run:
@@ -5,16 +5,19 @@ AlphaFold Pipeline for Vertex AI / Cloud Batch
 =============================================================================
 Purpose: Run AlphaFold protein structure prediction on Google Cloud
 Usage:
-    python alphafold_pipeline.py --sequence MVLSPADKTNVKAAWGKVGAHAGEYGAEALERMFLSFPTTKTYFPHFDLSH
-    python alphafold_pipeline.py --fasta protein.fasta --output gs://bucket/results
+    python alphafold_pipeline.py --db-share 10.0.0.2:/alphafold_dbs --sequence MVLSPADKTNVKAAWGKVGAHAGEYGAEALERMFLSFPTTKTYFPHFDLSH
+    python alphafold_pipeline.py --db-share 10.0.0.2:/alphafold_dbs --fasta protein.fasta --output gs://bucket/results
 
 IMPORTANT: AlphaFold Database Options
 =====================================
 AlphaFold requires large reference databases (~2.5TB for full_dbs). For a POC:
 
 1. USE reduced_dbs (default) - Only ~600GB, faster predictions, good accuracy
-2. For production, consider:
-   - Pre-staging databases in a regional GCS bucket
+2. Tasks mount the databases read-only from a Filestore share or a GCS
+   bucket (--db-share), populated once with download_all_data.sh. Filestore
+   is faster for HHsuite's small random reads. For production, consider:
+   - Pre-splitting the jackhmmer databases into shards (--db-shards)
+   - Building MSAs with MMseqs2-GPU on the ColabFold DBs (--msa-backend)
    - Using Google's public AlphaFold DB: gs://alphafold-public-datasets/
    - DeepMind's pre-computed structures: https://alphafold.ebi.ac.uk/
 
@@ -25,15 +28,24 @@ Cost Comparison:
 """
 
 import argparse
+import concurrent.futures
+import copy
+import functools
 import json
-import subprocess
+import os
 import sys
+import time
+import urllib.request
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
 
+import google.auth
+from google.api_core.exceptions import GoogleAPICallError, NotFound
 from google.cloud import aiplatform
+from google.cloud import batch_v1
 from google.cloud import storage
+from google.cloud.storage import transfer_manager
 
 
 # Default configuration
@@ -41,6 +53,7 @@ PROJECT_ID = None  # Will use gcloud default
 REGION = "us-central1"
 STAGING_BUCKET = None  # Will be auto-generated
 ALPHAFOLD_IMAGE = "gcr.io/cloud-lifesciences/alphafold:2.3.2"
+METADATA_PROJECT_URL = "http://metadata.google.internal/computeMetadata/v1/project/project-id"
 
 # Public AlphaFold database locations (for reference)
 PUBLIC_ALPHAFOLD_DBS = {
@@ -49,23 +62,462 @@ PUBLIC_ALPHAFOLD_DBS = {
     "mgnify": "gs://alphafold-public-datasets/mgnify/",
 }
 
+# AlphaFold databases and model params live on a shared Filestore (NFS)
+# instance or in a GCS bucket, mounted read-only into every task instead of a
+# per-task 500 GB disk. For --db-shards N, each jackhmmer database also has
+# pre-split siblings <db>.1 .. <db>.N (the chunk naming AlphaFold's own
+# streamed search uses) and, optionally, <db>.seqcount holding the unsharded
+# sequence count (otherwise the shards are counted once per task).
+ALPHAFOLD_DATA_DIR = "/data/alphafold_dbs"
+DB_MOUNT_OPTIONS = ["ro", "nconnect=8"]
+# Kernel readahead for the DB mount. NFS defaults to 128 KB, far too little for
+# the multi-GB sequential jackhmmer/hhblits scans; set on the host before the
+# container starts, since the tools' own reads cannot be changed
+DB_READ_AHEAD_KB = 16384
+
+# Cloud Storage FUSE: the DBs never change, so metadata is cached for the whole
+# run, and large sequential read-ahead suits the jackhmmer/hhblits scans
+DB_GCS_MOUNT_OPTIONS = [
+    "-o ro",
+    "--implicit-dirs",
+    "--file-mode=444",
+    "--dir-mode=555",
+    "--stat-cache-ttl=12h",
+    "--type-cache-ttl=12h",
+    "--max-conns-per-host=100",
+    "--sequential-read-size-mb=200",
+]
+MAX_TEMPLATE_DATE = "2022-01-01"
+
+# Stage 1 (MSA + templates) is CPU/IO-bound and runs without a GPU;
+# stage 2 (model inference + relax) gets the smallest GPU whose memory holds
+# the longest sequence in each bucket, by estimate_vram_gb. Above one GPU's
+# memory, unified memory (XLA memory fraction > 1) lets large inputs spill to
+# host RAM instead of OOM.
+FEATURES_MACHINE_TYPE = "c3-highcpu-44"
+INFERENCE_MACHINES = [
+    {"name": "l4", "machine_type": "g2-standard-16",
+     "gpu": "NVIDIA L4", "accelerator": "NVIDIA_L4", "gpu_mem_gb": 24,
+     "cpu_milli": 15000, "memory_mib": 60000, "mem_fraction": "1.0"},
+    {"name": "a100", "machine_type": "a2-highgpu-1g",
+     "gpu": "NVIDIA A100 40GB", "accelerator": "NVIDIA_TESLA_A100", "gpu_mem_gb": 40,
+     "cpu_milli": 12000, "memory_mib": 80000, "mem_fraction": "2.0"},
+    {"name": "a100-80gb", "machine_type": "a2-ultragpu-1g",
+     "gpu": "NVIDIA A100 80GB", "accelerator": "NVIDIA_A100_80GB", "gpu_mem_gb": 80,
+     "cpu_milli": 12000, "memory_mib": 160000, "mem_fraction": "4.0"},
+]
+# Amber relax of each target's best model runs after inference as its own
+# short job on an L4, instead of holding the inference GPU (--no-relax skips it)
+RELAX_MACHINE = {"name": "relax", "machine_type": "g2-standard-8", "gpu": "NVIDIA L4",
+                 "cpu_milli": 7000, "memory_mib": 28000}
+
+# --pack K runs up to K AlphaFold processes side by side on one GPU (through
+# CUDA MPS), as many as fit in PACK_GPU_FRACTION of its memory by
+# estimate_vram_gb. Small proteins leave most of an A100 idle otherwise.
+PACK_GPU_FRACTION = 0.9
+# AF2 inference memory: ~0.00002 * L^2 + 0.01 * L GB for L residues, plus the
+# params and JAX runtime held by every process
+VRAM_PROCESS_GB = 4.0
+
+# validate_sequence lookup table: byte -> 0 (amino acid) or 1 (invalid)
+_AA_TABLE = bytes(0 if chr(i).upper() in "ACDEFGHIKLMNPQRSTVWY" else 1 for i in range(256))
+_AA_INVALID = b"\x01"
+_SEQUENCE_WHITESPACE = b" \n\r\t"
+
+# Files above one chunk are uploaded as parallel chunks (XML multipart)
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_WORKERS = 8
+
+# Outputs are rsynced to GCS this often while AlphaFold runs, so finished
+# models are already uploaded when the last one completes
+OUTPUT_SYNC_SECONDS = 30
+FEATURES_PKL_PATTERN = r".*features\.pkl$"
+
+# MSA cache: each target's msas/ directory is stored under
+# <msa cache>/<model preset>/<sha256 of its chain sequences>, so re-running a
+# sequence (with any flags) restores its searches instead of repeating them.
+# Chains are unwrapped, upper-cased and hashed one per line, in order.
+MSA_KEY_FUNCTION = r"""msa_key() {
+    awk '/^>/ {if (s) print s; s = ""; next} {s = s $0} END {print s}' "$1" \
+        | tr -d ' \r\t' | tr a-z A-Z | sha256sum | cut -d' ' -f1
+}"""
+
+# --fasta-dir groups sequences into buckets of this many residues; each bucket
+# is one Batch task that runs all of its sequences in one AlphaFold process, so
+# params, JAX init and compiled executables (same-length inputs) are reused
+LENGTH_BUCKET = 32
+
+# --matmul-precision -> JAX_DEFAULT_MATMUL_PRECISION for the inference stage;
+# "high" lets XLA use TF32 tensor cores for default-precision matmuls
+# (same meaning as torch.set_float32_matmul_precision), "default" leaves XLA's
+# own choice. The image's JAX predates the default/high/highest aliases.
+MATMUL_PRECISIONS = {"default": None, "high": "tensorfloat32", "highest": "float32"}
+
+# Zones offering each GPU machine, tried for the inference stage (override
+# with --zones); the CPU stage may run anywhere in the region
+GPU_ZONES = {
+    "g2-standard-8": {"us-central1": ["us-central1-a", "us-central1-b", "us-central1-c"]},
+    "g2-standard-16": {"us-central1": ["us-central1-a", "us-central1-b", "us-central1-c"]},
+    "a2-highgpu-1g": {"us-central1": ["us-central1-a", "us-central1-b", "us-central1-c", "us-central1-f"]},
+    "a2-ultragpu-1g": {"us-central1": ["us-central1-a", "us-central1-c"]},
+}
+# Spot preemptions surface as this task exit code; they are retried, up to
+# MAX_RETRY_COUNT times, without failing the job
+PREEMPTION_EXIT_CODE = 50001
+MAX_RETRY_COUNT = 5
+# Job states after which polling stops (a deleted job stops with "DELETED")
+BATCH_TERMINAL_STATES = ("SUCCEEDED", "FAILED", "CANCELLED", "DELETION_IN_PROGRESS")
+
+# CPUs per MSA tool when the three searches run side by side (44 vCPUs total)
+JACKHMMER_N_CPU = 16
+HHBLITS_N_CPU = 12
+
+# --msa-backend: "jackhmmer" runs AlphaFold's own searches on the CPU VM.
+# The others build one MSA per target up front and hand it to AlphaFold as a
+# precomputed MSA (templates are still searched against AlphaFold's PDB DBs):
+#   mmseqs2_gpu      - MMseqs2-GPU on an L4, against the ColabFold DBs, which
+#                      live in colabfold/ on the DB share (setup_databases.sh
+#                      with GPU=1, so they are padded for GPU search)
+#   colabfold_remote - the public ColabFold MSA server; sequences leave the project
+MSA_BACKENDS = ("jackhmmer", "mmseqs2_gpu", "colabfold_remote")
+MMSEQS_IMAGE = "ghcr.io/soedinglab/mmseqs2:gpu"
+MMSEQS_MACHINE = INFERENCE_MACHINES[0]  # L4
+COLABFOLD_DB_DIR = f"{ALPHAFOLD_DATA_DIR}/colabfold"
+COLABFOLD_API = "https://api.colabfold.com"
+# Name of the external MSA in each target's msas/ directory
+MSA_A3M = "colabfold.a3m"
+# Host directories shared between the MMseqs2 and AlphaFold containers
+MSA_HOST_DIR = "/mnt/disks/msas"
+GCS_INPUT_DIR = "/mnt/disks/gcs"
+
+# JAX persistent compilation cache for the inference stage. The models are
+# compiled once per process and input shape; with --jax-cache the compiled
+# executables are restored from and saved to GCS around each task, so later
+# jobs at the same lengths skip compilation. Kept per GPU machine, as entries
+# only match the device they were compiled for. Opt-in: GPU caching needs a
+# JAX with the jax_compilation_cache_dir option, newer than the 0.3.25 in the
+# stock 2.3.2 image (there the cache is TPU-only, so tasks just warn).
+JAX_CACHE_DIR = "/tmp/jax_cache"
+
+# Runs the stock run_alphafold.py in one of four stages (ALPHAFOLD_STAGE):
+#   features  - MSAs and templates only, ending at <target>/features.pkl
+#   inference - models from an existing features.pkl, no databases
+#   all       - both, in one task
+#   relax     - Amber relax of the best unrelaxed model of finished targets
+# The uniref90, mgnify and bfd searches are launched concurrently
+# (ParaFold-style). They write their hit files into the MSA directory first;
+# the unmodified pipeline then picks them up as precomputed MSAs and continues
+# with template search and featurization.
+ALPHAFOLD_WRAPPER = """
+import copy
+import functools
+import json
+import os
+import pickle
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, "/app/alphafold")
+from absl import app
+from alphafold.common import protein
+from alphafold.data import parsers, pipeline, pipeline_multimer, templates
+from alphafold.data.tools import hhsearch, hmmsearch
+from alphafold.relax import relax
+
+import run_alphafold
+
+STAGE = os.environ.get("ALPHAFOLD_STAGE", "all")
+DB_SHARDS = int(os.environ.get("DB_SHARDS", "1"))
+MSA_A3M = os.environ.get("MSA_A3M")
+_process = pipeline.DataPipeline.process
+_LOWER = dict.fromkeys(range(ord("a"), ord("z") + 1))
+
+
+def _a3m_to_sto(sequences, descriptions):
+    # Insertions (lower case) are dropped and every remaining column is a
+    # match state, which is what hmmbuild --hand reads from the RF line
+    rows = [s.translate(_LOWER) for s in sequences]
+    lines = ["# STOCKHOLM 1.0", ""]
+    lines += [f"#=GS hit{i} DE {d}" for i, d in enumerate(descriptions)]
+    lines += [f"hit{i} {row}" for i, row in enumerate(rows)]
+    lines += ["#=GC RF " + "x" * len(rows[0]), "//"]
+    return "\\n".join(lines) + "\\n"
+
+
+def _write_external_msas(msa_output_dir, use_small_bfd):
+    # One external MSA stands in for all three searches: it becomes the
+    # uniref90 hits (also the template query), the others hold just the query
+    with open(os.path.join(msa_output_dir, MSA_A3M)) as f:
+        sequences, descriptions = parsers.parse_fasta(f.read())
+    query = _a3m_to_sto(sequences[:1], descriptions[:1])
+    msas = {"uniref90_hits.sto": _a3m_to_sto(sequences, descriptions), "mgnify_hits.sto": query}
+    if use_small_bfd:
+        msas["small_bfd_hits.sto"] = query
+    else:
+        msas["bfd_uniref_hits.a3m"] = f">{descriptions[0]}\\n{sequences[0]}\\n"
+    for name, msa in msas.items():
+        path = os.path.join(msa_output_dir, name)
+        if not os.path.exists(path):
+            with open(path, "w") as f:
+                f.write(msa)
+
+
+def _sto_rows(sto):
+    rows, descriptions = {}, {}
+    for line in sto.splitlines():
+        if line.startswith("#=GS") and " DE " in line:
+            _, name, _, description = line.split(maxsplit=3)
+            descriptions[name] = description
+        elif line.strip() and not line.startswith(("#", "//")):
+            name, chunk = line.split()
+            rows[name] = rows.get(name, "") + chunk
+    return rows, descriptions
+
+
+@functools.lru_cache(maxsize=None)
+def _db_size(database_path, shards):
+    # Sequences in the unsharded DB: <db>.seqcount if present, else counted
+    # once over the shards
+    try:
+        with open(f"{database_path}.seqcount") as f:
+            return int(f.read())
+    except FileNotFoundError:
+        pass
+    def count(i):
+        result = subprocess.run(["grep", "-c", "^>", f"{database_path}.{i}"],
+                                capture_output=True, text=True, check=True)
+        return int(result.stdout)
+    with ThreadPoolExecutor(max_workers=shards) as executor:
+        return sum(executor.map(count, range(1, shards + 1)))
+
+
+class ShardedJackhmmer:
+    # Searches <db>.1 .. <db>.N side by side and merges the hits into one
+    # Stockholm alignment on the query's match columns, ordered by E-value.
+    # Every shard is scored against the unsharded DB size (jackhmmer -Z), so
+    # E-values match one search over the whole DB.
+    def __init__(self, runner, shards):
+        z_value = _db_size(runner.database_path, shards)
+        self.runners = []
+        for i in range(1, shards + 1):
+            shard = copy.copy(runner)
+            shard.database_path = f"{runner.database_path}.{i}"
+            shard.n_cpu = max(1, runner.n_cpu // shards)
+            shard.z_value = z_value
+            self.runners.append(shard)
+
+    def query(self, input_fasta_path, max_sequences=None):
+        with ThreadPoolExecutor(max_workers=len(self.runners)) as executor:
+            results = list(executor.map(
+                lambda r: r.query(input_fasta_path, max_sequences)[0], self.runners))
+        evalues, descriptions, segmented = {}, {}, []
+        for result in results:
+            for line in result["tbl"].splitlines():
+                if line and not line.startswith("#"):
+                    fields = line.split()
+                    evalues[fields[0]] = float(fields[4])
+            rows, desc = _sto_rows(result["sto"])
+            descriptions.update(desc)
+            query = next(iter(rows.values()), "")
+            match = [i for i, c in enumerate(query) if c not in "-."]
+            for name, row in rows.items():
+                bounds = [-1] + match + [len(row)]
+                inserts = [row[a + 1:b] for a, b in zip(bounds, bounds[1:])]
+                segmented.append((name, [row[i] for i in match], inserts))
+        width = [max(len(s[2][k]) for s in segmented) for k in range(len(segmented[0][2]))]
+        query_name = segmented[0][0]
+        hits = sorted((s for s in segmented if s[0] != query_name),
+                      key=lambda s: evalues.get(s[0].rsplit("/", 1)[0], float("inf")))
+        if max_sequences:
+            hits = hits[:max_sequences - 1]
+        lines = ["# STOCKHOLM 1.0", ""]
+        lines += [f"#=GS {s[0]} DE {descriptions[s[0]]}" for s in hits if s[0] in descriptions]
+        for name, matches, inserts in [segmented[0]] + hits:
+            row = inserts[0].ljust(width[0], "-") + "".join(
+                m + ins.ljust(w, "-") for m, ins, w in zip(matches, inserts[1:], width[1:]))
+            lines.append(f"{name} {row}")
+        # Query match columns are match states, padded insert columns are not;
+        # remove_empty_columns_from_stockholm_msa needs this line
+        rf = "." * width[0] + "".join("x" + "." * w for w in width[1:])
+        lines += ["#=GC RF " + rf, "//"]
+        return [{"sto": "\\n".join(lines) + "\\n", "tbl": "".join(r["tbl"] for r in results)}]
+
+
+def process(self, input_fasta_path, msa_output_dir):
+    if MSA_A3M and os.path.exists(os.path.join(msa_output_dir, MSA_A3M)):
+        _write_external_msas(msa_output_dir, self._use_small_bfd)
+        self.use_precomputed_msas = True
+    self.jackhmmer_uniref90_runner.n_cpu = int(os.environ["JACKHMMER_N_CPU"])
+    self.jackhmmer_mgnify_runner.n_cpu = int(os.environ["JACKHMMER_N_CPU"])
+    searches = [
+        (self.jackhmmer_uniref90_runner, "uniref90_hits.sto", "sto", self.uniref_max_hits),
+        (self.jackhmmer_mgnify_runner, "mgnify_hits.sto", "sto", self.mgnify_max_hits),
+    ]
+    if self._use_small_bfd:
+        self.jackhmmer_small_bfd_runner.n_cpu = int(os.environ["JACKHMMER_N_CPU"])
+        searches.append((self.jackhmmer_small_bfd_runner, "small_bfd_hits.sto", "sto", None))
+    else:
+        self.hhblits_bfd_uniref_runner.n_cpu = int(os.environ["HHBLITS_N_CPU"])
+        searches.append((self.hhblits_bfd_uniref_runner, "bfd_uniref_hits.a3m", "a3m", None))
+    if DB_SHARDS > 1:
+        # Only the jackhmmer (Stockholm) searches are sharded; hhblits reads ffindex DBs
+        searches = [(ShardedJackhmmer(s[0], DB_SHARDS),) + s[1:] if s[2] == "sto" else s
+                    for s in searches]
+    with ThreadPoolExecutor(max_workers=len(searches)) as executor:
+        list(executor.map(
+            lambda s: pipeline.run_msa_tool(
+                s[0], input_fasta_path, os.path.join(msa_output_dir, s[1]), s[2],
+                self.use_precomputed_msas, s[3]),
+            searches))
+    self.use_precomputed_msas = True
+    return _process(self, input_fasta_path, msa_output_dir)
+
+
+def features_only(fasta_path, fasta_name, output_dir_base, data_pipeline, **kwargs):
+    output_dir = os.path.join(output_dir_base, fasta_name)
+    msa_output_dir = os.path.join(output_dir, "msas")
+    os.makedirs(msa_output_dir, exist_ok=True)
+    feature_dict = data_pipeline.process(
+        input_fasta_path=fasta_path, msa_output_dir=msa_output_dir)
+    with open(os.path.join(output_dir, "features.pkl"), "wb") as f:
+        pickle.dump(feature_dict, f, protocol=4)
+
+
+def relax_only(argv):
+    # Same settings and outputs as run_alphafold's relax of the top-ranked model
+    amber_relaxer = relax.AmberRelaxation(
+        max_iterations=run_alphafold.RELAX_MAX_ITERATIONS,
+        tolerance=run_alphafold.RELAX_ENERGY_TOLERANCE,
+        stiffness=run_alphafold.RELAX_STIFFNESS,
+        exclude_residues=run_alphafold.RELAX_EXCLUDE_RESIDUES,
+        max_outer_iterations=run_alphafold.RELAX_MAX_OUTER_ITERATIONS,
+        use_gpu=run_alphafold.FLAGS.use_gpu_relax)
+    for fasta_path in run_alphafold.FLAGS.fasta_paths:
+        fasta_name = os.path.splitext(os.path.basename(fasta_path))[0]
+        output_dir = os.path.join(run_alphafold.FLAGS.output_dir, fasta_name)
+        with open(os.path.join(output_dir, "ranking_debug.json")) as f:
+            best = json.load(f)["order"][0]
+        with open(os.path.join(output_dir, f"unrelaxed_{best}.pdb")) as f:
+            unrelaxed_protein = protein.from_pdb_string(f.read())
+        relaxed_pdb, _, violations = amber_relaxer.process(prot=unrelaxed_protein)
+        for name in (f"relaxed_{best}.pdb", "ranked_0.pdb"):
+            with open(os.path.join(output_dir, name), "w") as f:
+                f.write(relaxed_pdb)
+        with open(os.path.join(output_dir, "relax_metrics.json"), "w") as f:
+            json.dump({best: {"remaining_violations": violations,
+                              "remaining_violations_count": sum(violations)}}, f, indent=4)
+        print(f"Relaxed {fasta_name}: {best}")
 
+
+class PrecomputedFeatures:
+    # Stands in for the data pipeline and the template tools
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def process(self, input_fasta_path, msa_output_dir):
+        with open(os.path.join(os.path.dirname(msa_output_dir), "features.pkl"), "rb") as f:
+            return pickle.load(f)
+
+
+if STAGE == "inference":
+    pipeline.DataPipeline = pipeline_multimer.DataPipeline = PrecomputedFeatures
+    hhsearch.HHSearch = hmmsearch.Hmmsearch = PrecomputedFeatures
+    templates.HhsearchHitFeaturizer = templates.HmmsearchHitFeaturizer = PrecomputedFeatures
+else:
+    pipeline.DataPipeline.process = process
+if STAGE == "features":
+    run_alphafold.config.MODEL_PRESETS = {k: () for k in run_alphafold.config.MODEL_PRESETS}
+    run_alphafold.predict_structure = features_only
+elif os.environ.get("JAX_COMPILATION_CACHE_DIR"):
+    import jax
+    try:
+        jax.config.update("jax_compilation_cache_dir", os.environ["JAX_COMPILATION_CACHE_DIR"])
+        jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
+    except AttributeError:
+        # Older JAX (the 2.3.2 image) only caches compilations on TPU
+        print(f"Warning: JAX {jax.__version__} has no GPU compilation cache; compiling without it")
+
+if __name__ == "__main__":
+    app.run(relax_only if STAGE == "relax" else run_alphafold.main)
+"""
+
+
+# Fetches one MSA per FASTA (argv) from the ColabFold server into
+# /tmp/output/<name>/msas/, using UniRef30 and the environmental DBs
+COLABFOLD_REMOTE_CLIENT = f"""
+import io
+import json
+import os
+import sys
+import tarfile
+import time
+import urllib.parse
+import urllib.request
+
+
+def call(path, data=None):
+    body = urllib.parse.urlencode(data).encode() if data else None
+    with urllib.request.urlopen(urllib.request.Request("{COLABFOLD_API}/" + path, body), timeout=300) as r:
+        return r.read()
+
+
+for fasta in sys.argv[1:]:
+    name = os.path.splitext(os.path.basename(fasta))[0]
+    msa_path = os.path.join("/tmp/output", name, "msas", "{MSA_A3M}")
+    if os.path.exists(msa_path):
+        continue
+    with open(fasta) as f:
+        sequence = "".join(line.strip() for line in f if not line.startswith(">"))
+    ticket = json.loads(call("ticket/msa", {{"q": ">101\\n" + sequence, "mode": "env"}}))
+    while ticket["status"] in ("PENDING", "RUNNING", "RATELIMIT"):
+        time.sleep(10)
+        ticket = json.loads(call("ticket/" + ticket["id"]))
+    if ticket["status"] != "COMPLETE":
+        sys.exit(f"ColabFold MSA server: {{name}} {{ticket['status']}}")
+    with tarfile.open(fileobj=io.BytesIO(call("result/download/" + ticket["id"]))) as tar:
+        uniref = tar.extractfile("uniref.a3m").read().rstrip(b"\\0\\n")
+        env = tar.extractfile("bfd.mgnify30.metaeuk30.smag30.a3m").read().rstrip(b"\\0\\n")
+    os.makedirs(os.path.dirname(msa_path), exist_ok=True)
+    with open(msa_path, "wb") as f:
+        # The environmental MSA repeats the query; keep it once
+        f.write(b"\\n".join([uniref] + env.split(b"\\n")[2:]) + b"\\n")
+    print(f"ColabFold MSA: {{name}}")
+"""
+
+
+@functools.lru_cache(maxsize=1)
 def get_project_id() -> str:
-    """Get the current GCP project ID from gcloud config."""
-    result = subprocess.run(
-        ["gcloud", "config", "get-value", "project"],
-        capture_output=True,
-        text=True,
-        check=True,
-    )
-    return result.stdout.strip()
+    """Get the current GCP project ID from the environment, metadata server or ADC."""
+    project_id = os.environ.get("GOOGLE_CLOUD_PROJECT")
+    if project_id:
+        return project_id
+    # On GCE/GKE/Cloud Run the metadata server answers in milliseconds
+    request = urllib.request.Request(METADATA_PROJECT_URL, headers={"Metadata-Flavor": "Google"})
+    try:
+        with urllib.request.urlopen(request, timeout=1) as response:
+            return response.read().decode()
+    except OSError:
+        pass
+    # Elsewhere, resolved by the auth library (service account, metadata server, gcloud config)
+    _, project_id = google.auth.default()
+    if not project_id:
+        raise RuntimeError("No default project; pass --project or set GOOGLE_CLOUD_PROJECT")
+    return project_id
+
+
+@functools.lru_cache(maxsize=1)
+def get_batch_client() -> batch_v1.BatchServiceClient:
+    """Shared Cloud Batch client, so submits and polls reuse one channel."""
+    return batch_v1.BatchServiceClient()
 
 
-def validate_sequence(sequence: str) -> bool:
-    """Validate that a sequence contains only valid amino acids."""
-    valid_aa = set("ACDEFGHIKLMNPQRSTVWY")
-    sequence_upper = sequence.upper().replace(" ", "").replace("\n", "")
-    return all(aa in valid_aa for aa in sequence_upper)
+def validate_sequence(sequence: str) -> tuple[bool, int]:
+    """Validate that a sequence is non-empty and only amino acids; also returns its length."""
+    # One C-level pass: whitespace is deleted, anything left that is not an
+    # amino acid (either case) maps to 1; non-ASCII becomes "?" and fails too
+    residues = sequence.encode("ascii", "replace").translate(_AA_TABLE, delete=_SEQUENCE_WHITESPACE)
+    return len(residues) > 0 and _AA_INVALID not in residues, len(residues)
 
 
 def create_fasta_file(
@@ -77,32 +529,207 @@ def create_fasta_file(
     if output_path is None:
         output_path = f"/tmp/{name}.fasta"
     
-    fasta_content = f">{name}\n{sequence}\n"
-    
-    with open(output_path, "w") as f:
-        f.write(fasta_content)
+    # Header and sequence go out in one gather-write, without joining them first
+    fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.writev(fd, [b">", name.encode(), b"\n", sequence.encode("ascii"), b"\n"])
+    finally:
+        os.close(fd)
     
     return output_path
 
 
-def upload_to_gcs(local_path: str, gcs_path: str) -> str:
-    """Upload a local file to GCS."""
-    client = storage.Client()
-    
-    # Parse GCS path
+@functools.lru_cache(maxsize=1)
+def get_storage_client() -> storage.Client:
+    """Shared GCS client, so repeated uploads reuse one session and credentials."""
+    return storage.Client()
+
+
+@functools.lru_cache(maxsize=32)
+def get_bucket(bucket_name: str) -> storage.Bucket:
+    """Bucket handle on the shared client, built once per bucket."""
+    return get_storage_client().bucket(bucket_name)
+
+
+def _split_gcs_path(gcs_path: str) -> tuple[str, str]:
+    """Split gs://bucket/name (or bucket/name) into bucket and object name."""
     if gcs_path.startswith("gs://"):
         gcs_path = gcs_path[5:]
+    bucket_name, _, blob_name = gcs_path.partition("/")
+    return bucket_name, blob_name
+
+
+def upload_to_gcs(local_path: str, gcs_path: str) -> str:
+    """Upload a local file to GCS, in concurrent chunks when it is large."""
+    bucket_name, blob_name = _split_gcs_path(gcs_path)
+    blob = get_bucket(bucket_name).blob(blob_name)
     
-    bucket_name = gcs_path.split("/")[0]
-    blob_name = "/".join(gcs_path.split("/")[1:])
-    
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    blob.upload_from_filename(local_path)
+    if os.path.getsize(local_path) > UPLOAD_CHUNK_SIZE:
+        transfer_manager.upload_chunks_concurrently(
+            local_path, blob,
+            chunk_size=UPLOAD_CHUNK_SIZE,
+            worker_type=transfer_manager.THREAD,
+            max_workers=UPLOAD_WORKERS,
+        )
+    else:
+        blob.upload_from_filename(local_path)
     
     return f"gs://{bucket_name}/{blob_name}"
 
 
+def upload_many(local_paths: list[str], gcs_prefix: str) -> list[str]:
+    """Upload local files concurrently under one GCS prefix, keeping their file names."""
+    bucket_name, prefix = _split_gcs_path(gcs_prefix.rstrip("/"))
+    bucket = get_bucket(bucket_name)
+    blobs = [bucket.blob(f"{prefix}/{Path(path).name}") for path in local_paths]
+    
+    transfer_manager.upload_many(
+        list(zip(local_paths, blobs)),
+        worker_type=transfer_manager.THREAD,
+        max_workers=UPLOAD_WORKERS,
+        raise_exception=True,
+    )
+    return [f"gs://{bucket_name}/{blob.name}" for blob in blobs]
+
+
+def fasta_length(path: str) -> int:
+    """Total residue count of a local FASTA file (all chains)."""
+    with open(path) as f:
+        return sum(len(line.strip()) for line in f if not line.startswith(">"))
+
+
+def validate_fasta(path: str) -> tuple[bool, int]:
+    """validate_sequence over all chains of a local FASTA file."""
+    with open(path) as f:
+        return validate_sequence("".join(line for line in f if not line.startswith(">")))
+
+
+def bucket_fasta_files(fasta_paths: list[str]) -> list[list[str]]:
+    """Group local FASTA files by total residue count into LENGTH_BUCKET-wide buckets."""
+    buckets = {}
+    for path in fasta_paths:
+        buckets.setdefault(fasta_length(path) // LENGTH_BUCKET, []).append(path)
+    return [buckets[key] for key in sorted(buckets)]
+
+
+def inference_machine(seq_len: Optional[int]) -> dict:
+    """
+    Smallest INFERENCE_MACHINES entry whose GPU holds `seq_len` residues (A100 40GB if unknown).
+    
+    Lengths beyond every GPU get the largest, where check_gpu_memory decides
+    whether spilling to host RAM is enough.
+    """
+    if seq_len is None:
+        return INFERENCE_MACHINES[1]
+    need = estimate_vram_gb(seq_len)
+    return next((m for m in INFERENCE_MACHINES if need <= m["gpu_mem_gb"]), INFERENCE_MACHINES[-1])
+
+
+def estimate_vram_gb(seq_len: int) -> float:
+    """Approximate GPU memory (GB) of one AlphaFold process predicting `seq_len` residues."""
+    return 0.00002 * seq_len ** 2 + 0.01 * seq_len + VRAM_PROCESS_GB
+
+
+def check_gpu_memory(seq_lens: list[int]) -> bool:
+    """
+    Check that each length fits the GPU machine it would run on.
+    
+    Unified memory lets a process spill past the GPU into host RAM, up to the
+    machine's XLA memory fraction; beyond that (or host RAM) it certainly OOMs,
+    so those inputs are reported and False is returned. Spilling is only warned about.
+    """
+    fits = True
+    for seq_len in sorted(set(seq_lens)):
+        machine = inference_machine(seq_len)
+        need = estimate_vram_gb(seq_len)
+        limit = min(machine["gpu_mem_gb"] * float(machine["mem_fraction"]),
+                    machine["gpu_mem_gb"] + machine["memory_mib"] / 1024)
+        if need > limit:
+            print(f"Error: {seq_len} residues needs ~{need:.0f} GB, more than "
+                  f"{machine['machine_type']} can provide ({limit:.0f} GB)")
+            fits = False
+        elif need > machine["gpu_mem_gb"]:
+            print(f"Warning: {seq_len} residues needs ~{need:.0f} GB; beyond the "
+                  f"{machine['gpu']}'s {machine['gpu_mem_gb']} GB it spills to host RAM and runs slower")
+    return fits
+
+
+def pack_size(machine: dict, seq_len: Optional[int], pack: int) -> int:
+    """How many of up to `pack` processes at `seq_len` residues fit on `machine`'s GPU (at least 1)."""
+    if pack <= 1 or seq_len is None:
+        return 1
+    budget = PACK_GPU_FRACTION * machine["gpu_mem_gb"]
+    return max(1, min(pack, int(budget // estimate_vram_gb(seq_len))))
+
+
+# Static parts of the job specs, serialized once at import. Each call loads a
+# fresh copy and fills in only the per-job fields.
+_VERTEX_JOB_TEMPLATE = json.dumps({
+    "jobSpec": {
+        "workerPoolSpecs": [{
+            "machineSpec": {"acceleratorCount": 1},
+            "replicaCount": 1,
+            "diskSpec": {
+                "bootDiskType": "pd-ssd",
+                "bootDiskSizeGb": 500,  # AlphaFold DBs are large
+            },
+            "containerSpec": {
+                "imageUri": ALPHAFOLD_IMAGE,
+                "command": ["/bin/bash", "-c"],
+            },
+        }],
+    },
+})
+_VERTEX_ARGS_TEMPLATE = f"""
+python /app/alphafold/run_alphafold.py \\
+    --fasta_paths={{fasta_gcs_path}} \\
+    --output_dir={{output_gcs_path}} \\
+    --max_template_date={{max_template_date}} \\
+    --model_preset={{model_preset}} \\
+    --db_preset={{db_preset}} \\
+    --data_dir={ALPHAFOLD_DATA_DIR} \\
+    --use_gpu_relax=true
+"""
+
+_BATCH_JOB_TEMPLATE = json.dumps({
+    "taskGroups": [{
+        "taskSpec": {
+            "runnables": [{
+                "script": {
+                    "text": (
+                        f"echo {DB_READ_AHEAD_KB} > /sys/class/bdi/$(mountpoint -d {ALPHAFOLD_DATA_DIR})/read_ahead_kb"
+                        " || true"
+                    ),
+                },
+            }, {
+                "container": {
+                    "imageUri": ALPHAFOLD_IMAGE,
+                    "entrypoint": "/bin/bash",
+                    "volumes": [f"{ALPHAFOLD_DATA_DIR}:{ALPHAFOLD_DATA_DIR}:ro"],
+                },
+            }],
+            "maxRetryCount": MAX_RETRY_COUNT,
+            "lifecyclePolicies": [{
+                "action": "RETRY_TASK",
+                "actionCondition": {"exitCodes": [PREEMPTION_EXIT_CODE]},
+            }],
+            "maxRunDuration": "43200s",  # 12 hours
+        },
+    }],
+    "allocationPolicy": {
+        "instances": [{
+            "policy": {
+                "provisioningModel": "SPOT",  # Use Spot for cost savings
+                "bootDisk": {"sizeGb": 100, "type": "pd-ssd"},  # DBs are on the share
+            },
+        }],
+    },
+    "logsPolicy": {
+        "destination": "CLOUD_LOGGING",
+    },
+})
+
+
 def create_alphafold_pipeline(
     fasta_gcs_path: str,
     output_gcs_path: str,
@@ -111,173 +738,801 @@ def create_alphafold_pipeline(
     max_template_date: str = "2022-01-01",
     model_preset: str = "monomer",
     db_preset: str = "reduced_dbs",
+    seq_len: Optional[int] = None,
 ) -> dict:
     """Create the AlphaFold pipeline specification."""
     
+    machine = inference_machine(seq_len)
     job_name = f"alphafold-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
     
     # Define the pipeline as a Vertex AI custom job
-    pipeline_spec = {
-        "displayName": job_name,
-        "jobSpec": {
-            "workerPoolSpecs": [
-                {
-                    "machineSpec": {
-                        "machineType": "a2-highgpu-1g",  # 1x A100 GPU
-                        "acceleratorType": "NVIDIA_TESLA_A100",
-                        "acceleratorCount": 1,
-                    },
-                    "replicaCount": 1,
-                    "diskSpec": {
-                        "bootDiskType": "pd-ssd",
-                        "bootDiskSizeGb": 500,  # AlphaFold DBs are large
-                    },
-                    "containerSpec": {
-                        "imageUri": ALPHAFOLD_IMAGE,
-                        "command": ["/bin/bash", "-c"],
-                        "args": [
-                            f"""
-                            python /app/alphafold/run_alphafold.py \
-                                --fasta_paths={fasta_gcs_path} \
-                                --output_dir={output_gcs_path} \
-                                --max_template_date={max_template_date} \
-                                --model_preset={model_preset} \
-                                --db_preset={db_preset} \
-                                --data_dir=/data/alphafold_dbs \
-                                --use_gpu_relax=true
-                            """
-                        ],
-                    },
-                }
+    pipeline_spec = json.loads(_VERTEX_JOB_TEMPLATE)
+    pipeline_spec["displayName"] = job_name
+    pool = pipeline_spec["jobSpec"]["workerPoolSpecs"][0]
+    pool["machineSpec"]["machineType"] = machine["machine_type"]
+    pool["machineSpec"]["acceleratorType"] = machine["accelerator"]
+    pool["containerSpec"]["args"] = [_VERTEX_ARGS_TEMPLATE.format(
+        fasta_gcs_path=fasta_gcs_path,
+        output_gcs_path=output_gcs_path,
+        max_template_date=max_template_date,
+        model_preset=model_preset,
+        db_preset=db_preset,
+    )]
+    
+    return pipeline_spec
+
+
+def _db_flags(model_preset: str, db_preset: str) -> str:
+    """run_alphafold.py database flags for the standard download_all_data.sh layout."""
+    data = ALPHAFOLD_DATA_DIR
+    flags = [
+        f"--data_dir={data}",
+        f"--uniref90_database_path={data}/uniref90/uniref90.fasta",
+        f"--mgnify_database_path={data}/mgnify/mgy_clusters_2022_05.fa",
+        f"--template_mmcif_dir={data}/pdb_mmcif/mmcif_files",
+        f"--obsolete_pdbs_path={data}/pdb_mmcif/obsolete.dat",
+    ]
+    if db_preset == "reduced_dbs":
+        flags.append(f"--small_bfd_database_path={data}/small_bfd/bfd-first_non_consensus_sequences.fasta")
+    else:
+        flags.append(f"--bfd_database_path={data}/bfd/bfd_metaclust_clu_complete_id30_c90_final_seq.sorted_opt")
+        flags.append(f"--uniref30_database_path={data}/uniref30/UniRef30_2021_03")
+    if model_preset == "multimer":
+        flags.append(f"--pdb_seqres_database_path={data}/pdb_seqres/pdb_seqres.txt")
+        flags.append(f"--uniprot_database_path={data}/uniprot/uniprot.fasta")
+    else:
+        flags.append(f"--pdb70_database_path={data}/pdb70/pdb70")
+    return " \\\n    ".join(flags)
+
+
+def _run_alphafold(
+    stage: str,
+    model_preset: str,
+    db_preset: str,
+    *extra_flags: str,
+    db_shards: int = 1,
+    pack: int = 1,
+) -> str:
+    """
+    Shell lines writing the wrapper and running one AlphaFold stage.
+    
+    With `pack` > 1, the inputs (in $FASTA_PATHS order) are split into that many
+    contiguous slices, each run by its own process on the shared GPU.
+    """
+    fasta_paths = "$(paste -sd, $slice)" if pack > 1 else "$(ls -d /tmp/inputs/* | paste -sd, -)"
+    flags = " \\\n    ".join((
+        f"--fasta_paths={fasta_paths}",
+        "--output_dir=/tmp/output",
+        f"--max_template_date={MAX_TEMPLATE_DATE}",
+        f"--model_preset={model_preset}",
+        f"--db_preset={db_preset}",
+        _db_flags(model_preset, db_preset),
+        *extra_flags,
+    ))
+    setup = f"""cat > /tmp/run_alphafold_stage.py <<'PY'
+{ALPHAFOLD_WRAPPER}
+PY
+export ALPHAFOLD_STAGE={stage} DB_SHARDS={db_shards}
+export JACKHMMER_N_CPU={JACKHMMER_N_CPU} HHBLITS_N_CPU={HHBLITS_N_CPU}"""
+    if pack <= 1:
+        return f"""{setup}
+python /tmp/run_alphafold_stage.py \\
+    {flags}"""
+    # Length-ordered inputs, so each slice still repeats few input shapes
+    slice_flags = flags.replace("\n", "\n    ")
+    return f"""{setup}
+for path in $FASTA_PATHS; do echo /tmp/inputs/${{path##*/}}; done > /tmp/inputs.txt
+split -e -n l/{pack} -d /tmp/inputs.txt /tmp/slice.
+# MPS runs the processes' kernels concurrently instead of time-slicing the GPU
+nvidia-cuda-mps-control -d || echo "CUDA MPS unavailable; processes time-share the GPU"
+pids=""
+for slice in /tmp/slice.*; do
+    python /tmp/run_alphafold_stage.py \\
+        {slice_flags} &
+    pids="$pids $!"
+done
+for pid in $pids; do wait $pid; done"""
+
+
+def _db_volume(db_share: str) -> dict:
+    """Batch volume mounting the DB share: gs://bucket[/prefix] via FUSE, else NFS IP:/share."""
+    if db_share.startswith("gs://"):
+        return {
+            "gcs": {"remotePath": db_share[len("gs://"):]},
+            "mountPath": ALPHAFOLD_DATA_DIR,
+            "mountOptions": DB_GCS_MOUNT_OPTIONS,
+        }
+    server, remote_path = db_share.split(":", 1)
+    return {
+        "nfs": {"server": server, "remotePath": remote_path},
+        "mountPath": ALPHAFOLD_DATA_DIR,
+        "mountOptions": DB_MOUNT_OPTIONS,
+    }
+
+
+def _with_output_sync(command: str, output_gcs_path: str, exclude: Optional[str] = None) -> str:
+    """Shell lines running `command` while /tmp/output is synced to GCS in the background."""
+    rsync = "gcloud storage rsync --recursive"
+    if exclude:
+        rsync += f" --exclude='{exclude}'"
+    rsync += f" /tmp/output {output_gcs_path}"
+    return f"""export CLOUDSDK_STORAGE_PROCESS_COUNT=$(nproc) CLOUDSDK_STORAGE_THREAD_COUNT=8
+( while sleep {OUTPUT_SYNC_SECONDS}; do {rsync} > /dev/null 2>&1; done ) &
+SYNC_PID=$!
+{command}
+kill $SYNC_PID
+
+# Final sync once everything is written
+{rsync}"""
+
+
+def _restore_msas(msa_cache: str) -> str:
+    """Shell lines copying cached MSAs into each target's msas/ directory."""
+    return f"""{MSA_KEY_FUNCTION}
+for fasta in /tmp/inputs/*; do
+    name=$(basename "${{fasta%.*}}")
+    mkdir -p /tmp/output/$name/msas
+    if gcloud storage cp --recursive "{msa_cache}/$(msa_key $fasta)/*" /tmp/output/$name/msas/ 2>/dev/null; then
+        echo "MSA cache hit: $name"
+    fi
+done"""
+
+
+def _store_msas(msa_cache: str) -> str:
+    """Shell lines saving each target's msas/ directory to the cache (no-op on hits)."""
+    return f"""for fasta in /tmp/inputs/*; do
+    name=$(basename "${{fasta%.*}}")
+    gcloud storage rsync --recursive /tmp/output/$name/msas "{msa_cache}/$(msa_key $fasta)"
+done"""
+
+
+def _cached_a3m_runnable(msa_cache: str) -> dict:
+    """
+    Batch runnable copying cached MMseqs2 MSAs to MSA_HOST_DIR/<name>.a3m.
+    
+    Runs before _mmseqs_runnable (whose image has no gcloud), which then skips
+    the targets found here.
+    """
+    script = f"""
+set -e
+mkdir -p {MSA_HOST_DIR}
+{MSA_KEY_FUNCTION}
+for path in $FASTA_PATHS; do
+    fasta={GCS_INPUT_DIR}/${{path#gs://}}
+    name=$(basename "${{fasta%.*}}")
+    if gcloud storage cp "{msa_cache}/$(msa_key $fasta)/{MSA_A3M}" {MSA_HOST_DIR}/$name.a3m 2>/dev/null; then
+        echo "MSA cache hit: $name"
+    fi
+done
+"""
+    return {
+        "container": {
+            "imageUri": ALPHAFOLD_IMAGE,
+            "entrypoint": "/bin/bash",
+            "commands": ["-c", script],
+            "volumes": [
+                f"{GCS_INPUT_DIR}:{GCS_INPUT_DIR}:ro",
+                f"{MSA_HOST_DIR}:{MSA_HOST_DIR}",
             ],
         },
     }
+
+
+def _mmseqs_runnable() -> dict:
+    """
+    Batch runnable searching each of the task's FASTAs with MMseqs2-GPU.
     
-    return pipeline_spec
+    Writes <name>.a3m to MSA_HOST_DIR for the AlphaFold container, skipping
+    targets that already have one there (cache hits). The inputs are read
+    through GCS_INPUT_DIR, as the MMseqs2 image has no gcloud.
+    """
+    uniref = f"{COLABFOLD_DB_DIR}/uniref30_2302_db"
+    script = f"""
+set -e
+mkdir -p /tmp/q {MSA_HOST_DIR}
+for path in $FASTA_PATHS; do
+    fasta={GCS_INPUT_DIR}/${{path#gs://}}
+    name=$(basename "${{fasta%.*}}")
+    if [ -e {MSA_HOST_DIR}/$name.a3m ]; then
+        continue
+    fi
+    echo "MMseqs2-GPU search: $name"
+    mmseqs createdb "$fasta" /tmp/q/$name
+    mmseqs search /tmp/q/$name {uniref} /tmp/q/$name.res /tmp/q/tmp \\
+        --gpu 1 --num-iterations 3 -a -e 0.1 --max-seqs 10000 --db-load-mode 2
+    mmseqs result2msa /tmp/q/$name {uniref} /tmp/q/$name.res /tmp/q/$name.msa \\
+        --msa-format-mode 6 --filter-msa 1 --filter-min-enable 1000 --diff 3000 \\
+        --qid 0.0,0.2,0.4,0.6,0.8,1.0 --qsc 0 --max-seq-id 0.95 --db-load-mode 2
+    mmseqs unpackdb /tmp/q/$name.msa /tmp/q/$name.a3m --unpack-name-mode 0 --unpack-suffix .a3m
+    mv /tmp/q/$name.a3m/0.a3m {MSA_HOST_DIR}/$name.a3m
+done
+"""
+    return {
+        "container": {
+            "imageUri": MMSEQS_IMAGE,
+            "entrypoint": "/bin/bash",
+            "commands": ["-c", script],
+            "volumes": [
+                f"{ALPHAFOLD_DATA_DIR}:{ALPHAFOLD_DATA_DIR}:ro",
+                f"{GCS_INPUT_DIR}:{GCS_INPUT_DIR}:ro",
+                f"{MSA_HOST_DIR}:{MSA_HOST_DIR}",
+            ],
+        },
+    }
+
+
+def _stage_spec(
+    script: str,
+    machine_type: str,
+    cpu_milli: int,
+    memory_mib: int,
+    project_id: str,
+    region: str,
+    db_share: str,
+    fasta_buckets: list[list[str]],
+    gpu: bool = False,
+    zones: Optional[list[str]] = None,
+    environment: Optional[dict] = None,
+) -> dict:
+    """
+    Build a Cloud Batch job around a bash script, with the DB share mounted.
+    
+    One task per FASTA bucket; each task sees its bucket's GCS paths in $FASTA_PATHS.
+    Runs on Spot VMs in `zones` (default: anywhere in the region).
+    """
+    spec = json.loads(_BATCH_JOB_TEMPLATE)
+    group = spec["taskGroups"][0]
+    task = group["taskSpec"]
+    container = task["runnables"][1]
+    container["container"]["commands"] = ["-c", script]
+    container["environment"] = {"variables": environment or {}}
+    task["volumes"] = [_db_volume(db_share)]
+    task["computeResource"] = {"cpuMilli": cpu_milli, "memoryMib": memory_mib}
+    group["taskCount"] = group["parallelism"] = len(fasta_buckets)
+    group["taskEnvironments"] = [
+        {"variables": {"FASTA_PATHS": " ".join(bucket)}} for bucket in fasta_buckets
+    ]
+    
+    allocation = spec["allocationPolicy"]
+    instance = allocation["instances"][0]
+    instance["policy"]["machineType"] = machine_type
+    if gpu:
+        instance["installGpuDrivers"] = True
+    allocation["location"] = {
+        "allowedLocations": [f"zones/{zone}" for zone in zones] if zones else [f"regions/{region}"],
+    }
+    # Filestore is only reachable from its authorized VPC
+    allocation["network"] = {
+        "networkInterfaces": [{
+            "network": f"projects/{project_id}/global/networks/multiomics-vpc",
+            "subnetwork": f"projects/{project_id}/regions/{region}/subnetworks/multiomics-vpc",
+        }],
+    }
+    return spec
+
+
+def _cpu_stage_spec(
+    fasta_buckets: list[list[str]],
+    output_gcs_path: str,
+    project_id: str,
+    region: str,
+    db_share: str,
+    model_preset: str,
+    db_preset: str,
+    db_shards: int = 1,
+    msa_cache: Optional[str] = None,
+    msa_backend: str = "jackhmmer",
+) -> dict:
+    """
+    Stage 1: MSA search and template featurization, ending at features.pkl in GCS.
+    
+    With `msa_cache` (a gs:// prefix), searches whose hits are cached are skipped
+    and new MSAs are added to the cache. `msa_backend` is one of MSA_BACKENDS.
+    """
+    features = _run_alphafold(
+        "features", model_preset, db_preset,
+        "--models_to_relax=none", "--random_seed=0", "--use_gpu_relax=false",
+        "--use_precomputed_msas=true",
+        db_shards=db_shards,
+    )
+    if msa_backend != "jackhmmer":
+        features = f"export MSA_A3M={MSA_A3M}\n{features}"
+    if msa_cache:
+        msa_cache = f"{msa_cache.rstrip('/')}/{model_preset}"
+        if msa_backend != "jackhmmer":
+            msa_cache += f"-{msa_backend}"
+        cache_restore = f"\n# Reuse MSAs cached for these sequences\n{_restore_msas(msa_cache)}\n"
+        cache_store = f"\n# Cache this task's MSAs for future runs\n{_store_msas(msa_cache)}\n"
+    else:
+        cache_restore = cache_store = ""
+    if msa_backend == "mmseqs2_gpu":
+        external_msas = f"""
+# MSAs from the MMseqs2-GPU runnable, unless restored from the cache
+for fasta in /tmp/inputs/*; do
+    name=$(basename "${{fasta%.*}}")
+    mkdir -p /tmp/output/$name/msas
+    [ -e /tmp/output/$name/msas/{MSA_A3M} ] || cp {MSA_HOST_DIR}/$name.a3m /tmp/output/$name/msas/{MSA_A3M}
+done
+"""
+    elif msa_backend == "colabfold_remote":
+        external_msas = f"""
+# MSAs from the ColabFold server
+cat > /tmp/colabfold_msa.py <<'PY'
+{COLABFOLD_REMOTE_CLIENT}
+PY
+python /tmp/colabfold_msa.py /tmp/inputs/*
+"""
+    else:
+        external_msas = ""
+    script = f"""
+set -e
+
+echo "Starting AlphaFold feature generation..."
+echo "Input: $FASTA_PATHS"
+echo "Output: {output_gcs_path}"
+
+# Download this task's input FASTAs
+mkdir -p /tmp/inputs
+gcloud storage cp $FASTA_PATHS /tmp/inputs/
+{cache_restore}{external_msas}
+# MSAs (three searches in parallel, unless given) and templates; no models are loaded.
+# Features and MSAs are uploaded for the inference stage as they appear.
+{_with_output_sync(features, output_gcs_path)}
+{cache_store}
+echo "AlphaFold feature generation complete!"
+"""
+    if msa_backend != "mmseqs2_gpu":
+        return _stage_spec(
+            script,
+            machine_type=FEATURES_MACHINE_TYPE,
+            cpu_milli=43000,  # 43 vCPUs
+            memory_mib=80000,  # 80 GB
+            project_id=project_id,
+            region=region,
+            db_share=db_share,
+            fasta_buckets=fasta_buckets,
+        )
+    
+    # MMseqs2-GPU runs first on the L4, then AlphaFold (templates, features)
+    spec = _stage_spec(
+        script,
+        machine_type=MMSEQS_MACHINE["machine_type"],
+        cpu_milli=MMSEQS_MACHINE["cpu_milli"],
+        memory_mib=MMSEQS_MACHINE["memory_mib"],
+        project_id=project_id,
+        region=region,
+        db_share=db_share,
+        fasta_buckets=fasta_buckets,
+        gpu=True,
+        zones=GPU_ZONES[MMSEQS_MACHINE["machine_type"]].get(region),
+    )
+    task = spec["taskGroups"][0]["taskSpec"]
+    task["runnables"][1]["container"]["volumes"].append(f"{MSA_HOST_DIR}:{MSA_HOST_DIR}:ro")
+    task["runnables"].insert(1, _mmseqs_runnable())
+    if msa_cache:
+        task["runnables"].insert(1, _cached_a3m_runnable(msa_cache))
+    # Input buckets, read-only through Cloud Storage FUSE
+    for bucket in sorted({_split_gcs_path(path)[0] for paths in fasta_buckets for path in paths}):
+        task["volumes"].append({
+            "gcs": {"remotePath": bucket},
+            "mountPath": f"{GCS_INPUT_DIR}/{bucket}",
+            "mountOptions": ["-o ro", "--implicit-dirs"],
+        })
+    return spec
+
+
+def _gpu_stage_spec(
+    fasta_buckets: list[list[str]],
+    output_gcs_path: str,
+    project_id: str,
+    region: str,
+    db_share: str,
+    model_preset: str,
+    db_preset: str,
+    machine: dict,
+    zones: Optional[list[str]] = None,
+    matmul_precision: str = "high",
+    pack: int = 1,
+    jax_cache: Optional[str] = None,
+) -> dict:
+    """
+    Stage 2: model inference on `machine`'s GPU from precomputed features (relax is
+    left to `_relax_stage_spec`).
+    
+    With `pack` > 1, each task runs that many AlphaFold processes on the GPU, each
+    capped at an equal share of PACK_GPU_FRACTION of its memory. With `jax_cache`
+    (a gs:// prefix), compiled models are shared across jobs through GCS.
+    """
+    environment = {
+        # Allocate HBM on demand rather than reserving most of it at startup
+        "XLA_PYTHON_CLIENT_PREALLOCATE": "false",
+        "TF_FORCE_UNIFIED_MEMORY": "1",
+        "XLA_PYTHON_CLIENT_MEM_FRACTION": (
+            f"{PACK_GPU_FRACTION / pack:.3f}" if pack > 1 else machine["mem_fraction"]
+        ),
+    }
+    if MATMUL_PRECISIONS[matmul_precision]:
+        environment["JAX_DEFAULT_MATMUL_PRECISION"] = MATMUL_PRECISIONS[matmul_precision]
+    inference = _run_alphafold(
+        "inference", model_preset, db_preset, "--models_to_relax=none", "--use_gpu_relax=true", pack=pack)
+    if jax_cache:
+        jax_cache = f"{jax_cache.rstrip('/')}/{machine['name']}"
+        environment["JAX_COMPILATION_CACHE_DIR"] = JAX_CACHE_DIR
+        cache_restore = f"""
+# Restore models compiled by earlier jobs on this GPU
+mkdir -p {JAX_CACHE_DIR}
+gcloud storage rsync --recursive {jax_cache} {JAX_CACHE_DIR} 2>/dev/null || true
+"""
+        cache_store = f"""
+# Save newly compiled models for later jobs
+gcloud storage rsync --recursive {JAX_CACHE_DIR} {jax_cache}
+"""
+    else:
+        cache_restore = cache_store = ""
+    script = f"""
+set -e
+
+echo "Starting AlphaFold inference..."
+echo "Input: $FASTA_PATHS"
+echo "Output: {output_gcs_path}"
+
+# Download this task's input FASTAs and their stage-1 features
+mkdir -p /tmp/inputs
+gcloud storage cp $FASTA_PATHS /tmp/inputs/
+for fasta in /tmp/inputs/*; do
+    name=$(basename "${{fasta%.*}}")
+    mkdir -p /tmp/output/$name
+    gcloud storage cp {output_gcs_path}/$name/features.pkl /tmp/output/$name/features.pkl
+done
+{cache_restore}
+# Run the models; only the params under --data_dir are read.
+# Results are uploaded while later models run (features are already in GCS).
+{_with_output_sync(inference, output_gcs_path, exclude=FEATURES_PKL_PATTERN)}
+{cache_store}
+echo "AlphaFold prediction complete!"
+"""
+    return _stage_spec(
+        script,
+        machine_type=machine["machine_type"],
+        cpu_milli=machine["cpu_milli"],
+        memory_mib=machine["memory_mib"],
+        project_id=project_id,
+        region=region,
+        db_share=db_share,
+        fasta_buckets=fasta_buckets,
+        gpu=True,
+        zones=zones or GPU_ZONES[machine["machine_type"]].get(region, [f"{region}-a", f"{region}-b"]),
+        environment=environment,
+    )
+
+
+def _relax_stage_spec(
+    fasta_buckets: list[list[str]],
+    output_gcs_path: str,
+    project_id: str,
+    region: str,
+    db_share: str,
+    model_preset: str,
+    db_preset: str,
+) -> dict:
+    """Stage 3: Amber relax of each target's best model on an L4, after inference."""
+    relax = _run_alphafold("relax", model_preset, db_preset, "--use_gpu_relax=true")
+    script = f"""
+set -e
+
+echo "Starting AlphaFold relax..."
+echo "Input: $FASTA_PATHS"
+echo "Output: {output_gcs_path}"
+
+# Download this task's input FASTAs and their ranking and unrelaxed models
+mkdir -p /tmp/inputs
+gcloud storage cp $FASTA_PATHS /tmp/inputs/
+for fasta in /tmp/inputs/*; do
+    name=$(basename "${{fasta%.*}}")
+    mkdir -p /tmp/output/$name
+    gcloud storage cp "{output_gcs_path}/$name/ranking_debug.json" "{output_gcs_path}/$name/unrelaxed_*.pdb" /tmp/output/$name/
+done
+
+{relax}
+
+# Upload the relaxed models (ranked_0.pdb is replaced by the relaxed one)
+gcloud storage rsync --recursive /tmp/output {output_gcs_path}
+
+echo "AlphaFold relax complete!"
+"""
+    return _stage_spec(
+        script,
+        machine_type=RELAX_MACHINE["machine_type"],
+        cpu_milli=RELAX_MACHINE["cpu_milli"],
+        memory_mib=RELAX_MACHINE["memory_mib"],
+        project_id=project_id,
+        region=region,
+        db_share=db_share,
+        fasta_buckets=fasta_buckets,
+        gpu=True,
+        zones=GPU_ZONES[RELAX_MACHINE["machine_type"]].get(region),
+    )
+
+
+def submit_batch_job(
+    job_name: str,
+    job_spec: dict,
+    project_id: str,
+    region: str,
+) -> Optional[str]:
+    """Submit a Cloud Batch job."""
+    request = batch_v1.CreateJobRequest(
+        parent=f"projects/{project_id}/locations/{region}",
+        job_id=job_name,
+        job=batch_v1.Job.from_json(json.dumps(job_spec)),
+    )
+    
+    print(f"\nSubmitting {job_name} to Cloud Batch...")
+    try:
+        get_batch_client().create_job(request)
+    except GoogleAPICallError as e:
+        print(f"\n✗ Job submission failed:")
+        print(e)
+        return None
+    
+    print(f"\n✓ Job submitted successfully: {job_name}")
+    print(f"  Monitor at: https://console.cloud.google.com/batch/jobs?project={project_id}")
+    return job_name
+
+
+def wait_for_batch_job(
+    job_name: str,
+    project_id: str,
+    region: str,
+    poll_seconds: int = 60,
+    max_errors: int = 10,
+) -> str:
+    """
+    Poll a Cloud Batch job until it finishes and return its final state.
+    
+    A cancelled or deleted job ends the wait too, as does `max_errors`
+    consecutive API errors (returned as "UNKNOWN").
+    """
+    name = f"projects/{project_id}/locations/{region}/jobs/{job_name}"
+    errors = 0
+    while True:
+        try:
+            state = get_batch_client().get_job(name=name).status.state.name
+            errors = 0
+        except NotFound:
+            return "DELETED"
+        except GoogleAPICallError as e:
+            errors += 1
+            if errors >= max_errors:
+                print(f"  {job_name}: giving up after {errors} errors ({e.message})")
+                return "UNKNOWN"
+            state = f"UNKNOWN ({e.message})"
+        if state in BATCH_TERMINAL_STATES:
+            return state
+        print(f"  {job_name}: {state}")
+        time.sleep(poll_seconds)
+
+
+def _on_demand(job_spec: dict, tasks: Optional[list[int]] = None) -> dict:
+    """Copy of a job spec that provisions standard (non-Spot) VMs, optionally for some tasks only."""
+    job_spec = copy.deepcopy(job_spec)
+    job_spec["allocationPolicy"]["instances"][0]["policy"]["provisioningModel"] = "STANDARD"
+    if tasks is not None:
+        group = job_spec["taskGroups"][0]
+        group["taskEnvironments"] = [group["taskEnvironments"][i] for i in tasks]
+        group["taskCount"] = group["parallelism"] = len(tasks)
+    return job_spec
+
+
+def _failed_tasks(job_name: str, project_id: str, region: str) -> tuple[list[int], list[int]]:
+    """Indices of a job's failed tasks: (last run preempted, failed for another reason)."""
+    parent = f"projects/{project_id}/locations/{region}/jobs/{job_name}/taskGroups/group0"
+    preempted, other = [], []
+    for task in get_batch_client().list_tasks(parent=parent):
+        if task.status.state.name != "FAILED":
+            continue
+        exit_codes = [e.task_execution.exit_code for e in task.status.status_events
+                      if e.task_execution.exit_code]
+        index = int(task.name.rsplit("/", 1)[1])
+        if exit_codes and exit_codes[-1] == PREEMPTION_EXIT_CODE:
+            preempted.append(index)
+        else:
+            other.append(index)
+    return sorted(preempted), sorted(other)
+
+
+def _fallback_on_demand(
+    job_name: str,
+    job_spec: dict,
+    project_id: str,
+    region: str,
+) -> str:
+    """
+    Re-run a failed Spot job's preempted tasks on standard VMs and return the final state.
+    
+    Only tasks that ran out of retries on PREEMPTION_EXIT_CODE are re-run, and
+    only if no task failed for another reason (a script or input error would
+    fail again on standard VMs).
+    """
+    try:
+        preempted, other = _failed_tasks(job_name, project_id, region)
+    except GoogleAPICallError as e:
+        print(f"\n{job_name}: could not list its tasks ({e.message}); not retrying")
+        return "FAILED"
+    if other or not preempted:
+        print(f"\n{job_name}: tasks {other} failed without preemption; not retrying on standard VMs")
+        return "FAILED"
+    print(f"\n{job_name}: {len(preempted)} task(s) preempted past their retries; "
+          "re-running them on standard VMs...")
+    retry_name = f"{job_name}-ondemand"
+    if not submit_batch_job(retry_name, _on_demand(job_spec, preempted), project_id, region):
+        return "FAILED"
+    return wait_for_batch_job(retry_name, project_id, region)
+
+
+def _run_stage(
+    job_name: str,
+    job_spec: dict,
+    project_id: str,
+    region: str,
+    fallback_on_demand: bool,
+) -> str:
+    """Submit a stage and wait for it, re-running preempted tasks on standard VMs if asked."""
+    if not submit_batch_job(job_name, job_spec, project_id, region):
+        return "FAILED"
+    state = wait_for_batch_job(job_name, project_id, region)
+    if state == "FAILED" and fallback_on_demand:
+        state = _fallback_on_demand(job_name, job_spec, project_id, region)
+    return state
+
+
+def _retry_on_demand(
+    job_name: str,
+    job_spec: dict,
+    project_id: str,
+    region: str,
+) -> None:
+    """Wait for a submitted Spot job and re-run its preempted tasks on standard VMs if it fails."""
+    if wait_for_batch_job(job_name, project_id, region) == "FAILED":
+        _fallback_on_demand(job_name, job_spec, project_id, region)
 
 
 def run_alphafold_batch_job(
-    fasta_gcs_path: str,
+    fasta_buckets: list[list[str]],
     output_gcs_path: str,
     project_id: str,
     region: str,
+    db_share: str,
     model_preset: str = "monomer",
     db_preset: str = "reduced_dbs",
+    db_shards: int = 1,
+    msa_cache: Optional[str] = None,
+    msa_backend: str = "jackhmmer",
+    seq_lens: Optional[list[Optional[int]]] = None,
+    matmul_precision: str = "high",
+    pack: int = 1,
+    jax_cache: Optional[str] = None,
+    relax: bool = True,
+    zones: Optional[list[str]] = None,
+    fallback_on_demand: bool = False,
     dry_run: bool = False,
 ) -> Optional[str]:
     """
     Submit AlphaFold job using Cloud Batch (alternative to Vertex AI).
     This is more cost-effective for batch processing.
+    
+    Runs as two jobs: CPU feature generation, then GPU inference once the
+    features are in GCS, so the A100 is only billed for model time. Batch has
+    no cross-job dependencies, so stage 1 is polled before stage 2 is submitted.
+    Each stage runs one task per FASTA bucket (see `bucket_fasta_files`).
+    Inference is one job per GPU machine, chosen from each bucket's longest
+    sequence in `seq_lens` (see `inference_machine`). With `pack` > 1, up to that
+    many buckets of a machine share one task and GPU (see `pack_size`).
+    With `relax`, each inference job is waited on and followed by a relax job
+    on an L4 for the same targets.
+    With `fallback_on_demand`, tasks of a stage that fail by running out of
+    Spot preemption retries are re-run once on standard VMs (see
+    `_fallback_on_demand`); the inference jobs are also waited on for that.
     """
     
     job_name = f"alphafold-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
     
-    batch_job = {
-        "taskGroups": [{
-            "taskSpec": {
-                "runnables": [{
-                    "container": {
-                        "imageUri": ALPHAFOLD_IMAGE,
-                        "commands": ["/bin/bash", "-c"],
-                        "entrypoint": "",
-                        "volumes": ["/data"],
-                    },
-                    "script": {
-                        "text": f"""
-#!/bin/bash
-set -e
-
-echo "Starting AlphaFold prediction..."
-echo "Input: {fasta_gcs_path}"
-echo "Output: {output_gcs_path}"
-
-# Download input FASTA
-gsutil cp {fasta_gcs_path} /tmp/input.fasta
-
-# Run AlphaFold
-python /app/alphafold/run_alphafold.py \
-    --fasta_paths=/tmp/input.fasta \
-    --output_dir=/tmp/output \
-    --max_template_date=2022-01-01 \
-    --model_preset={model_preset} \
-    --db_preset={db_preset} \
-    --use_gpu_relax=true
-
-# Upload results
-gsutil -m cp -r /tmp/output/* {output_gcs_path}/
-
-echo "AlphaFold prediction complete!"
-                        """
-                    }
-                }],
-                "computeResource": {
-                    "cpuMilli": 12000,  # 12 vCPUs
-                    "memoryMib": 85000,  # 85 GB
-                },
-                "maxRetryCount": 1,
-                "maxRunDuration": "43200s",  # 12 hours
-            },
-            "taskCount": 1,
-            "parallelism": 1,
-        }],
-        "allocationPolicy": {
-            "instances": [{
-                "policy": {
-                    "machineType": "a2-highgpu-1g",
-                    "provisioningModel": "SPOT",  # Use Spot for cost savings
-                },
-                "installGpuDrivers": True,
-            }],
-            "location": {
-                "allowedLocations": [f"zones/{region}-a", f"zones/{region}-b"],
-            },
-        },
-        "logsPolicy": {
-            "destination": "CLOUD_LOGGING",
-        },
-    }
+    features_job = _cpu_stage_spec(
+        fasta_buckets, output_gcs_path, project_id, region, db_share,
+        model_preset, db_preset, db_shards, msa_cache, msa_backend)
+    machines = {}
+    for bucket, seq_len in zip(fasta_buckets, seq_lens or [None] * len(fasta_buckets)):
+        machine = inference_machine(seq_len)
+        tier = machines.setdefault(machine["name"], (machine, [], []))
+        tier[1].append(bucket)
+        tier[2].append(seq_len)
+    inference_jobs = {}
+    relax_jobs = {}
+    packs = {}
+    for name, (machine, buckets, lens) in machines.items():
+        # Buckets are in length order; K consecutive ones share a GPU
+        k = pack_size(machine, None if None in lens else max(lens), pack)
+        tasks = [sum(buckets[i:i + k], []) for i in range(0, len(buckets), k)]
+        packs[name] = k
+        inference_jobs[f"{job_name}-inference-{name}"] = _gpu_stage_spec(
+            tasks, output_gcs_path, project_id, region, db_share,
+            model_preset, db_preset, machine, zones, matmul_precision, k, jax_cache)
+        if relax:
+            relax_jobs[f"{job_name}-inference-{name}"] = _relax_stage_spec(
+                tasks, output_gcs_path, project_id, region, db_share, model_preset, db_preset)
     
     print("=" * 70)
     print("AlphaFold Batch Job Configuration")
     print("=" * 70)
     print(f"  Job Name:     {job_name}")
-    print(f"  Input FASTA:  {fasta_gcs_path}")
+    if sum(map(len, fasta_buckets)) == 1:
+        print(f"  Input FASTA:  {fasta_buckets[0][0]}")
+    else:
+        print(f"  Input FASTAs: {sum(map(len, fasta_buckets))} in {len(fasta_buckets)} length buckets")
     print(f"  Output:       {output_gcs_path}")
     print(f"  Model Preset: {model_preset}")
     print(f"  DB Preset:    {db_preset}")
-    print(f"  GPU:          NVIDIA A100 (Spot)")
+    print(f"  DB Share:     {db_share} ({db_shards} shard{'s' if db_shards > 1 else ''})")
+    if msa_backend == "mmseqs2_gpu":
+        print(f"  Features:     {MMSEQS_MACHINE['gpu']} (Spot), MSAs with MMseqs2-GPU")
+    else:
+        print(f"  Features:     {FEATURES_MACHINE_TYPE} (Spot), MSAs with {msa_backend}")
+    print(f"  MSA Cache:    {msa_cache or 'disabled'}")
+    print(f"  Matmul:       {matmul_precision} precision")
+    print(f"  JAX Cache:    {jax_cache or 'disabled'}")
+    for (machine, buckets, _), job in zip(machines.values(), inference_jobs.values()):
+        zones_used = job["allocationPolicy"]["location"]["allowedLocations"]
+        k = packs[machine["name"]]
+        print(f"  GPU:          {machine['gpu']} (Spot{', on-demand fallback' if fallback_on_demand else ''}), "
+              f"{len(buckets)} bucket{'s' if len(buckets) > 1 else ''}"
+              f"{f', {k} per GPU' if k > 1 else ''}")
+        print(f"                in {', '.join(z.split('/', 1)[1] for z in zones_used)}")
+    print(f"  Relax:        {'best model, ' + RELAX_MACHINE['gpu'] + ' (Spot)' if relax else 'disabled'}")
     print("=" * 70)
     
     if dry_run:
-        print("\n[DRY RUN] Job specification:")
-        print(json.dumps(batch_job, indent=2))
+        print("\n[DRY RUN] Stage 1 (features) job specification:")
+        print(json.dumps(features_job, indent=2))
+        for name, job in inference_jobs.items():
+            print(f"\n[DRY RUN] Stage 2 (inference) job specification: {name}")
+            print(json.dumps(job, indent=2))
+        for name, job in relax_jobs.items():
+            print(f"\n[DRY RUN] Stage 3 (relax) job specification: {name}-relax")
+            print(json.dumps(job, indent=2))
         return None
     
-    # Submit job using gcloud
-    job_json = json.dumps(batch_job)
-    cmd = [
-        "gcloud", "batch", "jobs", "submit", job_name,
-        "--project", project_id,
-        "--location", region,
-        "--config", "-",
-    ]
+    print("\nFeature generation runs first; GPU inference starts once it succeeds...")
+    state = _run_stage(
+        f"{job_name}-features", features_job, project_id, region, fallback_on_demand)
+    if state != "SUCCEEDED":
+        print(f"\n✗ Feature generation {state.lower()}; inference not submitted")
+        return None
     
-    print("\nSubmitting job to Cloud Batch...")
-    result = subprocess.run(
-        cmd,
-        input=job_json,
-        capture_output=True,
-        text=True,
-    )
+    if relax:
+        # Each GPU tier is followed by its relax job; the tiers proceed concurrently
+        def run_tier(name):
+            state = _run_stage(name, inference_jobs[name], project_id, region, fallback_on_demand)
+            if state == "SUCCEEDED":
+                state = _run_stage(f"{name}-relax", relax_jobs[name], project_id, region, fallback_on_demand)
+            return state
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(inference_jobs)) as executor:
+            states = list(executor.map(run_tier, inference_jobs))
+        for name, state in zip(inference_jobs, states):
+            print(f"  {name}: {state}")
+        return ", ".join(name for name, state in zip(inference_jobs, states) if state == "SUCCEEDED") or None
     
-    if result.returncode == 0:
-        print(f"\n✓ Job submitted successfully: {job_name}")
-        print(f"  Monitor at: https://console.cloud.google.com/batch/jobs?project={project_id}")
-        return job_name
-    else:
-        print(f"\n✗ Job submission failed:")
-        print(result.stderr)
-        return None
+    # The GPU tiers are independent jobs, so submit (and watch) them concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(inference_jobs)) as executor:
+        submitted = [name for name in executor.map(
+            lambda name: submit_batch_job(name, inference_jobs[name], project_id, region),
+            inference_jobs) if name]
+        if fallback_on_demand:
+            # Any tier's preempted tasks are re-run on standard VMs
+            list(executor.map(
+                lambda name: _retry_on_demand(name, inference_jobs[name], project_id, region),
+                submitted))
+    return ", ".join(submitted) or None
 
 
 def main():
@@ -287,13 +1542,19 @@ def main():
         epilog="""
 Examples:
   # Predict structure from sequence
-  python alphafold_pipeline.py --sequence MVLSPADKTNVKAAWGKVGAHAGEYGAEALERMFLSFPTTKTYFPHFDLSH
+  python alphafold_pipeline.py --db-share 10.0.0.2:/alphafold_dbs --sequence MVLSPADKTNVKAAWGKVGAHAGEYGAEALERMFLSFPTTKTYFPHFDLSH
 
   # Predict from FASTA file
-  python alphafold_pipeline.py --fasta proteins.fasta --output gs://my-bucket/alphafold-results
+  python alphafold_pipeline.py --db-share 10.0.0.2:/alphafold_dbs --fasta proteins.fasta --output gs://my-bucket/alphafold-results
+
+  # Predict every FASTA in a directory, batched by length
+  python alphafold_pipeline.py --db-share 10.0.0.2:/alphafold_dbs --fasta-dir proteins/
+
+  # Search 4-way sharded databases in parallel
+  python alphafold_pipeline.py --db-share 10.0.0.2:/alphafold_dbs --db-shards 4 --sequence MVLSPADKTNVKAAWGKVG
 
   # Dry run to see configuration
-  python alphafold_pipeline.py --sequence MVLSPADKTNVKAAWGKVG --dry-run
+  python alphafold_pipeline.py --db-share 10.0.0.2:/alphafold_dbs --sequence MVLSPADKTNVKAAWGKVG --dry-run
         """,
     )
     
@@ -306,6 +1567,10 @@ Examples:
         "--fasta", "-f",
         help="Path to FASTA file (local or GCS)",
     )
+    input_group.add_argument(
+        "--fasta-dir",
+        help="Local directory of FASTA files (*.fasta, *.fa), one prediction per file",
+    )
     
     parser.add_argument(
         "--output", "-o",
@@ -313,7 +1578,8 @@ Examples:
     )
     parser.add_argument(
         "--project", "-p",
-        help="GCP project ID (default: current gcloud project)",
+        help="GCP project ID (default: $GOOGLE_CLOUD_PROJECT, else the VM metadata server's project, "
+             "else Application Default Credentials; this can differ from the gcloud config project)",
     )
     parser.add_argument(
         "--region", "-r",
@@ -332,6 +1598,68 @@ Examples:
         default="reduced_dbs",
         help="Database preset (default: reduced_dbs for faster predictions)",
     )
+    parser.add_argument(
+        "--db-share",
+        help="Where the AlphaFold databases and params live: Filestore IP:/share or gs://bucket/prefix",
+    )
+    parser.add_argument(
+        "--db-shards",
+        type=int,
+        default=1,
+        help="Search each jackhmmer database as N pre-split shards in parallel (default: 1)",
+    )
+    parser.add_argument(
+        "--msa-backend",
+        choices=MSA_BACKENDS,
+        default="jackhmmer",
+        help="MSA search: AlphaFold's jackhmmer/HHblits, MMseqs2-GPU on the ColabFold DBs, "
+             "or the public ColabFold server (sends sequences outside the project) (default: jackhmmer)",
+    )
+    parser.add_argument(
+        "--msa-cache",
+        help="GCS prefix caching MSAs by sequence hash (default: gs://PROJECT-results-dev/alphafold/msa_cache)",
+    )
+    parser.add_argument(
+        "--no-msa-cache",
+        action="store_true",
+        help="Always run the MSA searches, without reading or writing the cache",
+    )
+    parser.add_argument(
+        "--jax-cache",
+        help="GCS prefix sharing compiled models between inference jobs, e.g. "
+             "gs://PROJECT-results-dev/alphafold/jax_cache (default: disabled; "
+             "needs a newer JAX than the stock 2.3.2 image's, which only caches on TPU)",
+    )
+    parser.add_argument(
+        "--matmul-precision",
+        choices=list(MATMUL_PRECISIONS),
+        default="high",
+        help="JAX matmul precision for inference: high = TF32 tensor cores, highest = FP32 (default: high)",
+    )
+    parser.add_argument(
+        "--pack",
+        type=int,
+        default=1,
+        metavar="K",
+        help="Run up to K length buckets per GPU as concurrent AlphaFold processes, "
+             "as many as fit in its memory (default: 1)",
+    )
+    parser.add_argument(
+        "--relax",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Amber-relax each target's best model on an L4 after inference; "
+             "--no-relax keeps only unrelaxed models (default: relax)",
+    )
+    parser.add_argument(
+        "--zones",
+        help="Comma-separated zones for the GPU stage (default: every zone offering the chosen GPU)",
+    )
+    parser.add_argument(
+        "--fallback-on-demand",
+        action="store_true",
+        help="Re-run a stage's tasks on standard VMs if they fail from repeated Spot preemption",
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
@@ -339,6 +1667,10 @@ Examples:
     )
     
     args = parser.parse_args()
+    if not args.db_share:
+        parser.error("--db-share is required (Filestore IP:/share or gs:// path with the AlphaFold databases)")
+    if args.msa_backend != "jackhmmer" and args.model_preset == "multimer":
+        parser.error(f"--msa-backend {args.msa_backend} supports monomer presets only")
     
     # Resolve project ID
     project_id = args.project or get_project_id()
@@ -346,9 +1678,13 @@ Examples:
     
     # Handle input
     if args.sequence:
-        if not validate_sequence(args.sequence):
+        valid, seq_len = validate_sequence(args.sequence)
+        if not valid:
             print("Error: Invalid amino acid sequence")
             sys.exit(1)
+        seq_lens = [seq_len]
+        if not check_gpu_memory(seq_lens):
+            sys.exit(1)
         
         # Create FASTA and upload
         local_fasta = create_fasta_file(args.sequence)
@@ -358,28 +1694,83 @@ Examples:
         if not args.dry_run:
             upload_to_gcs(local_fasta, fasta_gcs_path)
             print(f"Uploaded FASTA to: {fasta_gcs_path}")
+        fasta_buckets = [[fasta_gcs_path]]
+    elif args.fasta_dir:
+        local_paths = sorted(
+            str(p) for p in Path(args.fasta_dir).iterdir() if p.suffix in (".fasta", ".fa"))
+        if not local_paths:
+            print(f"Error: No FASTA files in {args.fasta_dir}")
+            sys.exit(1)
+        # Targets are named by file stem (output dir, features.pkl), so x.fa and
+        # x.fasta would overwrite each other
+        stems = {}
+        for path in local_paths:
+            stems.setdefault(Path(path).stem, []).append(Path(path).name)
+        clashes = [names for names in stems.values() if len(names) > 1]
+        if clashes:
+            print(f"Error: FASTA files share a target name: {'; '.join(', '.join(n) for n in clashes)}")
+            sys.exit(1)
+        invalid = [Path(path).name for path in local_paths if not validate_fasta(path)[0]]
+        if invalid:
+            print(f"Error: Invalid amino acid sequence in {', '.join(invalid)}")
+            sys.exit(1)
+        local_buckets = bucket_fasta_files(local_paths)
+        seq_lens = [max(map(fasta_length, bucket)) for bucket in local_buckets]
+        if not check_gpu_memory(seq_lens):
+            sys.exit(1)
+        staging_bucket = f"gs://{project_id}-staging-dev/alphafold-inputs/{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        if not args.dry_run:
+            upload_many(local_paths, staging_bucket)
+            print(f"Uploaded FASTAs to: {staging_bucket}/")
+        fasta_buckets = [
+            [f"{staging_bucket}/{Path(p).name}" for p in bucket] for bucket in local_buckets
+        ]
+        print(f"{len(local_paths)} FASTA files in {len(fasta_buckets)} length buckets")
     else:
         fasta_path = args.fasta
         if fasta_path.startswith("gs://"):
             fasta_gcs_path = fasta_path
+            seq_lens = None  # not downloaded; runs on the default A100
         else:
+            valid, seq_len = validate_fasta(fasta_path)
+            if not valid:
+                print(f"Error: Invalid amino acid sequence in {fasta_path}")
+                sys.exit(1)
+            seq_lens = [seq_len]
+            if not check_gpu_memory(seq_lens):
+                sys.exit(1)
             staging_bucket = f"gs://{project_id}-staging-dev/alphafold-inputs"
             fasta_gcs_path = f"{staging_bucket}/{Path(fasta_path).name}"
             if not args.dry_run:
                 upload_to_gcs(fasta_path, fasta_gcs_path)
                 print(f"Uploaded FASTA to: {fasta_gcs_path}")
+        fasta_buckets = [[fasta_gcs_path]]
+    
+    msa_cache = None if args.no_msa_cache else (
+        args.msa_cache or f"gs://{project_id}-results-dev/alphafold/msa_cache")
     
     # Resolve output path
     output_gcs_path = args.output or f"gs://{project_id}-results-dev/alphafold/{datetime.now().strftime('%Y%m%d_%H%M%S')}"
     
     # Run prediction
     job_name = run_alphafold_batch_job(
-        fasta_gcs_path=fasta_gcs_path,
+        fasta_buckets=fasta_buckets,
         output_gcs_path=output_gcs_path,
         project_id=project_id,
         region=args.region,
+        db_share=args.db_share,
         model_preset=args.model_preset,
         db_preset=args.db_preset,
+        db_shards=args.db_shards,
+        msa_cache=msa_cache,
+        msa_backend=args.msa_backend,
+        seq_lens=seq_lens,
+        matmul_precision=args.matmul_precision,
+        pack=args.pack,
+        jax_cache=args.jax_cache,
+        relax=args.relax,
+        zones=args.zones.split(",") if args.zones else None,
+        fallback_on_demand=args.fallback_on_demand,
         dry_run=args.dry_run,
     )
     
@@ -10,23 +10,68 @@ Usage:
 """
 
 import argparse
+import functools
 import json
+import os
 import subprocess
 import sys
+import time
 from datetime import datetime
 from typing import Optional
 
+from google.api_core.exceptions import GoogleAPICallError, NotFound
+from google.cloud import batch_v1
+
 
 # Default configuration
 DEEPVARIANT_VERSION = "1.5.0"
 DEEPVARIANT_IMAGE = f"google/deepvariant:{DEEPVARIANT_VERSION}-gpu"
+DEEPVARIANT_CPU_IMAGE = f"google/deepvariant:{DEEPVARIANT_VERSION}"
 MODEL_TYPE = "WGS"  # or WES, PACBIO, ONT_R104, HYBRID_PACBIO_ILLUMINA
 
+# Extra make_examples flags run_deepvariant would add, for models supported in sharded mode
+MAKE_EXAMPLES_ARGS = {
+    "WGS": "--channels=insert_size",
+    "WES": "--channels=insert_size",
+}
+
+# call_variants GPU profiles: name -> (machine type, accelerator, cpuMilli, memoryMib)
+CALL_VARIANTS_GPUS = {
+    "t4": ("n1-standard-8", {"type": "nvidia-tesla-t4", "count": 1}, 8000, 28000),
+    "a100": ("a2-highgpu-1g", {"type": "nvidia-tesla-a100", "count": 1}, 12000, 80000),
+}
+CALL_VARIANTS_BATCH_SIZE = 1024
+
+# Cloud Storage FUSE mount used when streaming the BAM instead of copying it
+BAM_MOUNT_PATH = "/mnt/disks/reads"
+BAM_MOUNT_OPTIONS = [
+    "--implicit-dirs",
+    "--file-mode=444",
+    "--dir-mode=555",
+    "--stat-cache-ttl=60m",
+    "--type-cache-ttl=60m",
+    "--max-conns-per-host=100",
+]
+
+# Scratch for --intermediate_results_dir: one 375GB NVMe local SSD, or RAM
+INTERMEDIATE_DIR = "/tmp/deepvariant/intermediate"
+SCRATCH_MOUNT_PATH = "/mnt/disks/scratch"
+SCRATCH_TYPES = ("local-ssd", "tmpfs", "pd-ssd")
 
+# Job states after which polling stops (a deleted job stops with "DELETED")
+BATCH_TERMINAL_STATES = ("SUCCEEDED", "FAILED", "CANCELLED", "DELETION_IN_PROGRESS")
+
+
+@functools.lru_cache(maxsize=1)
 def get_project_id() -> str:
-    """Get the current GCP project ID from gcloud config."""
+    """Get the current GCP project ID from the environment or gcloud config."""
+    # Set in Cloud Shell and most Google-managed runtimes; avoids forking gcloud
+    project_id = os.environ.get("GOOGLE_CLOUD_PROJECT")
+    if project_id:
+        return project_id
     result = subprocess.run(
         ["gcloud", "config", "get-value", "project"],
+        stdin=subprocess.DEVNULL,
         capture_output=True,
         text=True,
         check=True,
@@ -34,34 +79,26 @@ def get_project_id() -> str:
     return result.stdout.strip()
 
 
-def create_deepvariant_batch_job(
-    bam_path: str,
-    reference_path: str,
-    output_vcf_path: str,
-    output_gvcf_path: str,
-    project_id: str,
-    region: str,
-    model_type: str = MODEL_TYPE,
-    num_shards: int = 16,
-    use_spot: bool = True,
-) -> dict:
-    """Create Cloud Batch job specification for DeepVariant."""
-    
-    job_name = f"deepvariant-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
-    
-    # DeepVariant command
-    dv_command = f"""
-#!/bin/bash
-set -e
+@functools.lru_cache(maxsize=1)
+def get_batch_client() -> batch_v1.BatchServiceClient:
+    """Shared Cloud Batch client, so repeated submits and polls reuse one channel."""
+    return batch_v1.BatchServiceClient()
 
-echo "=============================================="
-echo "DeepVariant Variant Calling"
-echo "=============================================="
-echo "BAM:       {bam_path}"
-echo "Reference: {reference_path}"
-echo "Output:    {output_vcf_path}"
-echo "Model:     {model_type}"
-echo "=============================================="
+
+def _gcs_cp(src: str, dst: str) -> str:
+    """Shell line copying with gcloud storage, falling back to gsutil."""
+    return f"gcloud storage cp {src} {dst} 2>/dev/null || gsutil -m cp {src} {dst}"
+
+
+def _script_prelude(transfer_threads: int, slice_size: str) -> str:
+    """Transfer tuning and tool setup shared by every task script."""
+    return f"""
+# Parallel, sliced transfers for the multi-GB BAM and reference
+export CLOUDSDK_STORAGE_PROCESS_COUNT=$(nproc)
+export CLOUDSDK_STORAGE_THREAD_COUNT={transfer_threads}
+export CLOUDSDK_STORAGE_SLICED_OBJECT_DOWNLOAD_THRESHOLD=50M
+export CLOUDSDK_STORAGE_SLICED_OBJECT_DOWNLOAD_COMPONENT_SIZE={slice_size}
+export CLOUDSDK_STORAGE_PARALLEL_COMPOSITE_UPLOAD_ENABLED=True
 
 # Install gsutil (not in DeepVariant container by default)
 echo "Installing gsutil..."
@@ -72,77 +109,120 @@ pip3 install -q --no-cache-dir gsutil || pip install -q --no-cache-dir gsutil ||
 mkdir -p /tmp/deepvariant/input
 mkdir -p /tmp/deepvariant/output
 mkdir -p /tmp/deepvariant/intermediate
+"""
 
-# Download inputs using gcloud storage (fallback to gsutil)
-echo "Downloading BAM file..."
-gcloud storage cp {bam_path} /tmp/deepvariant/input/sample.bam 2>/dev/null || gsutil cp {bam_path} /tmp/deepvariant/input/sample.bam
-echo "Downloading BAM index..."
-gcloud storage cp {bam_path}.bai /tmp/deepvariant/input/sample.bam.bai 2>/dev/null || samtools index /tmp/deepvariant/input/sample.bam || true
 
-echo "Downloading reference genome..."
+def _fetch_reference(reference_path: str) -> str:
+    """Shell lines staging the reference FASTA and its index locally."""
+    return f"""echo "Downloading reference genome..."
 gcloud storage cp {reference_path} /tmp/deepvariant/input/reference.fasta 2>/dev/null || gsutil cp {reference_path} /tmp/deepvariant/input/reference.fasta
-gcloud storage cp {reference_path}.fai /tmp/deepvariant/input/reference.fasta.fai 2>/dev/null || samtools faidx /tmp/deepvariant/input/reference.fasta || true
+gcloud storage cp {reference_path}.fai /tmp/deepvariant/input/reference.fasta.fai 2>/dev/null || samtools faidx /tmp/deepvariant/input/reference.fasta || true"""
 
-# Run DeepVariant
-echo "Running DeepVariant..."
-/opt/deepvariant/bin/run_deepvariant \\
-    --model_type={model_type} \\
-    --ref=/tmp/deepvariant/input/reference.fasta \\
-    --reads=/tmp/deepvariant/input/sample.bam \\
-    --output_vcf=/tmp/deepvariant/output/sample.vcf.gz \\
-    --output_gvcf=/tmp/deepvariant/output/sample.g.vcf.gz \\
-    --num_shards={num_shards} \\
-    --intermediate_results_dir=/tmp/deepvariant/intermediate
 
-# Upload outputs
-echo "Uploading results..."
-gcloud storage cp /tmp/deepvariant/output/sample.vcf.gz {output_vcf_path} 2>/dev/null || gsutil cp /tmp/deepvariant/output/sample.vcf.gz {output_vcf_path}
-gcloud storage cp /tmp/deepvariant/output/sample.vcf.gz.tbi {output_vcf_path}.tbi 2>/dev/null || gsutil cp /tmp/deepvariant/output/sample.vcf.gz.tbi {output_vcf_path}.tbi
-gcloud storage cp /tmp/deepvariant/output/sample.g.vcf.gz {output_gvcf_path} 2>/dev/null || gsutil cp /tmp/deepvariant/output/sample.g.vcf.gz {output_gvcf_path}
+def _fetch_bam(bam_path: str, stream_bam: bool) -> tuple[str, str]:
+    """Shell lines making the BAM available, and the path DeepVariant should read."""
+    if stream_bam:
+        # Mount the BAM's directory read-only so make_examples reads regions
+        # on demand while it runs, instead of waiting for a full download
+        reads_path = f"{BAM_MOUNT_PATH}/{bam_path.rsplit('/', 1)[1]}"
+        return f"""echo "Streaming BAM from {bam_path} via Cloud Storage FUSE ({BAM_MOUNT_PATH})..."
+test -f {reads_path}.bai || {{ echo "Missing BAM index {bam_path}.bai (required when streaming)"; exit 1; }}""", reads_path
+    
+    reads_path = "/tmp/deepvariant/input/sample.bam"
+    return f"""echo "Downloading BAM file..."
+gcloud storage cp {bam_path} {reads_path} 2>/dev/null || gsutil cp {bam_path} {reads_path}
+echo "Downloading BAM index..."
+gcloud storage cp {bam_path}.bai {reads_path}.bai 2>/dev/null || samtools index {reads_path} || true""", reads_path
 
-echo "=============================================="
-echo "DeepVariant complete!"
-echo "VCF:  {output_vcf_path}"
-echo "gVCF: {output_gvcf_path}"
-echo "=============================================="
-"""
+
+def _mount_bam(batch_job: dict, bam_path: str) -> None:
+    """Attach the BAM's GCS directory to the job as a read-only FUSE volume."""
+    task_spec = batch_job["taskGroups"][0]["taskSpec"]
+    task_spec.setdefault("volumes", []).append({
+        "gcs": {"remotePath": bam_path[len("gs://"):].rsplit("/", 1)[0]},
+        "mountPath": BAM_MOUNT_PATH,
+        "mountOptions": BAM_MOUNT_OPTIONS,
+    })
+    task_spec["runnables"][0]["container"].setdefault("volumes", []).append(
+        f"{BAM_MOUNT_PATH}:{BAM_MOUNT_PATH}:ro"
+    )
+
+
+def _attach_scratch(batch_job: dict, scratch: str, tmpfs_size: str = "64g") -> None:
+    """
+    Back the intermediate directory with faster scratch than the boot disk.
     
-    batch_job = {
+    "local-ssd" attaches a local NVMe SSD that Batch formats and mounts on the
+    host, "tmpfs" keeps intermediates in RAM (only for runs whose tfrecords fit
+    in `tmpfs_size`), and "pd-ssd" leaves them on the boot disk.
+    """
+    task_spec = batch_job["taskGroups"][0]["taskSpec"]
+    container = task_spec["runnables"][0]["container"]
+    if scratch == "local-ssd":
+        policy = batch_job["allocationPolicy"]["instances"][0]["policy"]
+        policy["disks"] = [{
+            "newDisk": {"sizeGb": 375, "type": "local-ssd"},
+            "deviceName": "scratch",
+        }]
+        task_spec.setdefault("volumes", []).append({
+            "deviceName": "scratch",
+            "mountPath": SCRATCH_MOUNT_PATH,
+            "mountOptions": ["rw", "async"],
+        })
+        container.setdefault("volumes", []).append(f"{SCRATCH_MOUNT_PATH}:{INTERMEDIATE_DIR}")
+    elif scratch == "tmpfs":
+        container["options"] = f"--tmpfs {INTERMEDIATE_DIR}:rw,size={tmpfs_size}"
+
+
+def _batch_job_spec(
+    script: str,
+    project_id: str,
+    region: str,
+    machine_type: str,
+    cpu_milli: int,
+    memory_mib: int,
+    use_spot: bool,
+    image: str = DEEPVARIANT_IMAGE,
+    task_count: int = 1,
+    gpu: Optional[dict] = None,
+    max_run_duration: str = "14400s",
+) -> dict:
+    """Build a single-task-group Cloud Batch job around a bash script."""
+    policy = {
+        "machineType": machine_type,
+        "provisioningModel": "SPOT" if use_spot else "STANDARD",
+        "bootDisk": {
+            "sizeGb": 100,  # 100GB for WGS data
+            "type": "pd-ssd",
+        },
+    }
+    instance = {"policy": policy}
+    if gpu:
+        policy["accelerators"] = [gpu]
+        instance["installGpuDrivers"] = True
+    
+    return {
         "taskGroups": [{
             "taskSpec": {
                 "runnables": [{
                     "container": {
-                        "imageUri": DEEPVARIANT_IMAGE,
+                        "imageUri": image,
                         "entrypoint": "/bin/bash",
-                        "commands": ["-c", dv_command],
+                        "commands": ["-c", script],
                     },
                 }],
                 "computeResource": {
-                    "cpuMilli": 32000,  # 32 vCPUs
-                    "memoryMib": 128000,  # 128 GB
+                    "cpuMilli": cpu_milli,
+                    "memoryMib": memory_mib,
                 },
                 "maxRetryCount": 1,
-                "maxRunDuration": "14400s",  # 4 hours
+                "maxRunDuration": max_run_duration,
             },
-            "taskCount": 1,
-            "parallelism": 1,
+            "taskCount": task_count,
+            "parallelism": task_count,
         }],
         "allocationPolicy": {
-            "instances": [{
-                "policy": {
-                    "machineType": "n1-standard-32",
-                    "provisioningModel": "SPOT" if use_spot else "STANDARD",
-                    "accelerators": [{
-                        "type": "nvidia-tesla-t4",
-                        "count": 1,
-                    }],
-                    "bootDisk": {
-                        "sizeGb": 100,  # 100GB for WGS data
-                        "type": "pd-ssd",
-                    },
-                },
-                "installGpuDrivers": True,
-            }],
+            "instances": [instance],
             "location": {
                 "allowedLocations": [f"zones/{region}-a", f"zones/{region}-b", f"zones/{region}-c"],
             },
@@ -157,10 +237,241 @@ echo "=============================================="
             "destination": "CLOUD_LOGGING",
         },
     }
+
+
+def _upload_outputs(output_vcf_path: str, output_gvcf_path: str) -> str:
+    """Shell lines uploading the final VCF, its index and the gVCF."""
+    return f"""echo "Uploading results..."
+gcloud storage cp /tmp/deepvariant/output/sample.vcf.gz {output_vcf_path} 2>/dev/null || gsutil cp /tmp/deepvariant/output/sample.vcf.gz {output_vcf_path}
+gcloud storage cp /tmp/deepvariant/output/sample.vcf.gz.tbi {output_vcf_path}.tbi 2>/dev/null || gsutil cp /tmp/deepvariant/output/sample.vcf.gz.tbi {output_vcf_path}.tbi
+gcloud storage cp /tmp/deepvariant/output/sample.g.vcf.gz {output_gvcf_path} 2>/dev/null || gsutil cp /tmp/deepvariant/output/sample.g.vcf.gz {output_gvcf_path}
+
+echo "=============================================="
+echo "DeepVariant complete!"
+echo "VCF:  {output_vcf_path}"
+echo "gVCF: {output_gvcf_path}"
+echo "=============================================="
+"""
+
+
+def create_deepvariant_batch_job(
+    bam_path: str,
+    reference_path: str,
+    output_vcf_path: str,
+    output_gvcf_path: str,
+    project_id: str,
+    region: str,
+    model_type: str = MODEL_TYPE,
+    num_shards: int = 16,
+    use_spot: bool = True,
+    transfer_threads: int = 8,
+    slice_size: str = "200M",
+    stream_bam: bool = False,
+    call_variants_batch_size: int = CALL_VARIANTS_BATCH_SIZE,
+    scratch: str = "local-ssd",
+    tmpfs_size: str = "64g",
+) -> dict:
+    """Create Cloud Batch job specification for DeepVariant."""
+    
+    job_name = f"deepvariant-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    fetch_bam, reads_path = _fetch_bam(bam_path, stream_bam)
+    
+    # DeepVariant command
+    dv_command = f"""
+#!/bin/bash
+set -e
+
+echo "=============================================="
+echo "DeepVariant Variant Calling"
+echo "=============================================="
+echo "BAM:       {bam_path}"
+echo "Reference: {reference_path}"
+echo "Output:    {output_vcf_path}"
+echo "Model:     {model_type}"
+echo "=============================================="
+{_script_prelude(transfer_threads, slice_size)}
+# Download inputs using gcloud storage (fallback to gsutil)
+{fetch_bam}
+
+{_fetch_reference(reference_path)}
+
+# Run DeepVariant
+echo "Running DeepVariant..."
+/opt/deepvariant/bin/run_deepvariant \\
+    --model_type={model_type} \\
+    --ref=/tmp/deepvariant/input/reference.fasta \\
+    --reads={reads_path} \\
+    --output_vcf=/tmp/deepvariant/output/sample.vcf.gz \\
+    --output_gvcf=/tmp/deepvariant/output/sample.g.vcf.gz \\
+    --num_shards={num_shards} \\
+    --call_variants_extra_args="batch_size={call_variants_batch_size}" \\
+    --intermediate_results_dir=/tmp/deepvariant/intermediate
+
+# Upload outputs
+{_upload_outputs(output_vcf_path, output_gvcf_path)}"""
+    
+    batch_job = _batch_job_spec(
+        dv_command,
+        project_id,
+        region,
+        machine_type="n1-standard-32",
+        cpu_milli=32000,  # 32 vCPUs
+        memory_mib=128000,  # 128 GB
+        use_spot=use_spot,
+        gpu={"type": "nvidia-tesla-t4", "count": 1},
+    )
+    
+    if stream_bam:
+        _mount_bam(batch_job, bam_path)
+    _attach_scratch(batch_job, scratch, tmpfs_size)
     
     return job_name, batch_job
 
 
+def create_sharded_deepvariant_jobs(
+    bam_path: str,
+    reference_path: str,
+    output_vcf_path: str,
+    output_gvcf_path: str,
+    work_dir: str,
+    project_id: str,
+    region: str,
+    model_type: str = MODEL_TYPE,
+    num_shards: int = 16,
+    use_spot: bool = True,
+    transfer_threads: int = 8,
+    slice_size: str = "200M",
+    call_variants_gpu: str = "a100",
+    call_variants_batch_size: int = CALL_VARIANTS_BATCH_SIZE,
+    scratch: str = "local-ssd",
+    tmpfs_size: str = "64g",
+) -> list[tuple[str, dict]]:
+    """
+    Create the three DeepVariant stages as separate Cloud Batch jobs.
+    
+    make_examples runs as `num_shards` parallel tasks (one shard each, selected
+    by BATCH_TASK_INDEX) on CPU-only VMs, call_variants runs alone on a GPU VM,
+    and postprocess_variants runs on a small CPU VM. Stages exchange files
+    through `work_dir` and must be run in order. Each make_examples task only
+    reads its own regions, so the BAM is always streamed (needs <bam>.bai).
+    """
+    if model_type not in MAKE_EXAMPLES_ARGS:
+        raise ValueError(
+            f"Sharded mode supports {', '.join(MAKE_EXAMPLES_ARGS)} models, not {model_type}"
+        )
+    
+    prefix = f"deepvariant-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    prelude = _script_prelude(transfer_threads, slice_size)
+    fetch_bam, reads_path = _fetch_bam(bam_path, stream_bam=True)
+    examples = f"/tmp/deepvariant/intermediate/examples.tfrecord@{num_shards}.gz"
+    gvcf_records = f"/tmp/deepvariant/intermediate/gvcf.tfrecord@{num_shards}.gz"
+    call_variants_output = "/tmp/deepvariant/intermediate/call_variants_output.tfrecord.gz"
+    
+    make_examples_script = f"""
+#!/bin/bash
+set -e
+{prelude}
+{fetch_bam}
+
+{_fetch_reference(reference_path)}
+
+echo "make_examples: shard ${{BATCH_TASK_INDEX}} of {num_shards}"
+/opt/deepvariant/bin/make_examples \\
+    --mode=calling \\
+    --ref=/tmp/deepvariant/input/reference.fasta \\
+    --reads={reads_path} \\
+    --examples={examples} \\
+    --gvcf={gvcf_records} \\
+    --task=${{BATCH_TASK_INDEX}} {MAKE_EXAMPLES_ARGS[model_type]}
+
+{_gcs_cp("/tmp/deepvariant/intermediate/*", f"{work_dir}/examples/")}
+"""
+    
+    call_variants_script = f"""
+#!/bin/bash
+set -e
+{prelude}
+echo "Downloading examples from {work_dir}/examples..."
+{_gcs_cp(f"'{work_dir}/examples/examples.tfrecord-*'", "/tmp/deepvariant/intermediate/")}
+
+echo "Running call_variants..."
+/opt/deepvariant/bin/call_variants \\
+    --outfile={call_variants_output} \\
+    --examples={examples} \\
+    --batch_size={call_variants_batch_size} \\
+    --checkpoint=/opt/models/{model_type.lower()}/model.ckpt
+
+{_gcs_cp(call_variants_output, f"{work_dir}/")}
+"""
+    
+    postprocess_script = f"""
+#!/bin/bash
+set -e
+{prelude}
+{_fetch_reference(reference_path)}
+
+echo "Downloading call_variants output and gVCF records..."
+{_gcs_cp(f"{work_dir}/call_variants_output.tfrecord.gz", "/tmp/deepvariant/intermediate/")}
+{_gcs_cp(f"'{work_dir}/examples/gvcf.tfrecord-*'", "/tmp/deepvariant/intermediate/")}
+
+echo "Running postprocess_variants..."
+/opt/deepvariant/bin/postprocess_variants \\
+    --ref=/tmp/deepvariant/input/reference.fasta \\
+    --infile={call_variants_output} \\
+    --outfile=/tmp/deepvariant/output/sample.vcf.gz \\
+    --nonvariant_site_tfrecord_path={gvcf_records} \\
+    --gvcf_outfile=/tmp/deepvariant/output/sample.g.vcf.gz
+
+{_upload_outputs(output_vcf_path, output_gvcf_path)}"""
+    
+    make_examples_job = _batch_job_spec(
+        make_examples_script,
+        project_id,
+        region,
+        machine_type="n2-highcpu-32",  # packs 16 single-threaded shards per VM
+        cpu_milli=2000,
+        memory_mib=1800,
+        use_spot=use_spot,
+        image=DEEPVARIANT_CPU_IMAGE,
+        task_count=num_shards,
+    )
+    _mount_bam(make_examples_job, bam_path)
+    
+    machine_type, gpu, cpu_milli, memory_mib = CALL_VARIANTS_GPUS[call_variants_gpu]
+    call_variants_job = _batch_job_spec(
+        call_variants_script,
+        project_id,
+        region,
+        machine_type=machine_type,
+        cpu_milli=cpu_milli,
+        memory_mib=memory_mib,
+        use_spot=use_spot,
+        gpu=gpu,
+    )
+    
+    postprocess_job = _batch_job_spec(
+        postprocess_script,
+        project_id,
+        region,
+        machine_type="n2-standard-8",
+        cpu_milli=8000,
+        memory_mib=30000,
+        use_spot=use_spot,
+        image=DEEPVARIANT_CPU_IMAGE,
+    )
+    
+    # make_examples tasks each write one small shard, so only the single-task
+    # stages that hold the full set of examples get dedicated scratch
+    _attach_scratch(call_variants_job, scratch, tmpfs_size)
+    _attach_scratch(postprocess_job, scratch, tmpfs_size)
+    
+    return [
+        (f"{prefix}-make-examples", make_examples_job),
+        (f"{prefix}-call-variants", call_variants_job),
+        (f"{prefix}-postprocess", postprocess_job),
+    ]
+
+
 def submit_batch_job(
     job_name: str,
     job_spec: dict,
@@ -175,30 +486,56 @@ def submit_batch_job(
         print(json.dumps(job_spec, indent=2))
         return None
     
-    job_json = json.dumps(job_spec)
-    cmd = [
-        "gcloud", "batch", "jobs", "submit", job_name,
-        "--project", project_id,
-        "--location", region,
-        "--config", "-",
-    ]
-    
-    print("\nSubmitting job to Cloud Batch...")
-    result = subprocess.run(
-        cmd,
-        input=job_json,
-        capture_output=True,
-        text=True,
+    request = batch_v1.CreateJobRequest(
+        parent=f"projects/{project_id}/locations/{region}",
+        job_id=job_name,
+        job=batch_v1.Job.from_json(json.dumps(job_spec)),
     )
     
-    if result.returncode == 0:
-        print(f"\n✓ Job submitted successfully: {job_name}")
-        print(f"  Monitor at: https://console.cloud.google.com/batch/jobs?project={project_id}")
-        return job_name
-    else:
+    print("\nSubmitting job to Cloud Batch...")
+    try:
+        get_batch_client().create_job(request)
+    except GoogleAPICallError as e:
         print(f"\n✗ Job submission failed:")
-        print(result.stderr)
+        print(e)
         return None
+    
+    print(f"\n✓ Job submitted successfully: {job_name}")
+    print(f"  Monitor at: https://console.cloud.google.com/batch/jobs?project={project_id}")
+    return job_name
+
+
+def wait_for_batch_job(
+    job_name: str,
+    project_id: str,
+    region: str,
+    poll_seconds: int = 60,
+    max_errors: int = 10,
+) -> str:
+    """
+    Poll a Cloud Batch job until it finishes and return its final state.
+    
+    A cancelled or deleted job ends the wait too, as does `max_errors`
+    consecutive API errors (returned as "UNKNOWN").
+    """
+    name = f"projects/{project_id}/locations/{region}/jobs/{job_name}"
+    errors = 0
+    while True:
+        try:
+            state = get_batch_client().get_job(name=name).status.state.name
+            errors = 0
+        except NotFound:
+            return "DELETED"
+        except GoogleAPICallError as e:
+            errors += 1
+            if errors >= max_errors:
+                print(f"  {job_name}: giving up after {errors} errors ({e.message})")
+                return "UNKNOWN"
+            state = f"UNKNOWN ({e.message})"
+        if state in BATCH_TERMINAL_STATES:
+            return state
+        print(f"  {job_name}: {state}")
+        time.sleep(poll_seconds)
 
 
 def main():
@@ -222,6 +559,9 @@ Examples:
 
   # Use standard VMs instead of Spot
   python deepvariant_batch.py --bam gs://bucket/sample.bam --reference gs://bucket/ref.fasta --no-spot
+
+  # Shard make_examples across 32 Batch tasks, then call_variants and postprocess_variants
+  python deepvariant_batch.py --bam gs://bucket/sample.bam --reference gs://bucket/ref.fasta --sharded --num-shards 32
         """,
     )
     
@@ -260,6 +600,54 @@ Examples:
         default=16,
         help="Number of shards for parallel processing (default: 16)",
     )
+    parser.add_argument(
+        "--transfer-threads",
+        type=int,
+        default=8,
+        help="Threads per process for gcloud storage transfers (default: 8)",
+    )
+    parser.add_argument(
+        "--slice-size",
+        default="200M",
+        help="Component size for sliced BAM/reference downloads (default: 200M)",
+    )
+    parser.add_argument(
+        "--stream-bam",
+        action="store_true",
+        help="Stream the BAM through a Cloud Storage FUSE mount instead of copying it "
+             "(requires <bam>.bai alongside the BAM)",
+    )
+    parser.add_argument(
+        "--sharded",
+        action="store_true",
+        help="Run make_examples as --num-shards parallel Batch tasks on CPU VMs, then "
+             "call_variants on a GPU VM and postprocess_variants as separate jobs "
+             "(WGS/WES only; streams the BAM)",
+    )
+    parser.add_argument(
+        "--call-variants-gpu",
+        choices=sorted(CALL_VARIANTS_GPUS),
+        default="a100",
+        help="GPU profile for the call_variants stage in --sharded mode (default: a100)",
+    )
+    parser.add_argument(
+        "--call-variants-batch-size",
+        type=int,
+        default=CALL_VARIANTS_BATCH_SIZE,
+        help=f"Examples per call_variants inference batch (default: {CALL_VARIANTS_BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--scratch",
+        choices=SCRATCH_TYPES,
+        default="local-ssd",
+        help="Storage for intermediate results: local NVMe SSD, RAM-backed tmpfs "
+             "(small runs only) or the pd-ssd boot disk (default: local-ssd)",
+    )
+    parser.add_argument(
+        "--tmpfs-size",
+        default="64g",
+        help="Size limit of the tmpfs used with --scratch tmpfs (default: 64g)",
+    )
     parser.add_argument(
         "--no-spot",
         action="store_true",
@@ -273,6 +661,9 @@ Examples:
     
     args = parser.parse_args()
     
+    if args.sharded and args.model_type not in MAKE_EXAMPLES_ARGS:
+        parser.error(f"--sharded supports {', '.join(MAKE_EXAMPLES_ARGS)} models only")
+    
     # Resolve project ID
     project_id = args.project or get_project_id()
     print(f"Using project: {project_id}")
@@ -296,8 +687,56 @@ Examples:
     print(f"  Model Type:   {args.model_type}")
     print(f"  Num Shards:   {args.num_shards}")
     print(f"  Use Spot:     {not args.no_spot}")
+    print(f"  Stream BAM:   {args.stream_bam or args.sharded}")
+    print(f"  Sharded:      {args.sharded}")
+    print(f"  Scratch:      {args.scratch}")
     print("=" * 70)
     
+    if args.sharded:
+        work_dir = output_vcf.rsplit("/", 1)[0] + "/deepvariant-work"
+        stages = create_sharded_deepvariant_jobs(
+            bam_path=args.bam,
+            reference_path=args.reference,
+            output_vcf_path=output_vcf,
+            output_gvcf_path=output_gvcf,
+            work_dir=work_dir,
+            project_id=project_id,
+            region=args.region,
+            model_type=args.model_type,
+            num_shards=args.num_shards,
+            use_spot=not args.no_spot,
+            transfer_threads=args.transfer_threads,
+            slice_size=args.slice_size,
+            call_variants_gpu=args.call_variants_gpu,
+            call_variants_batch_size=args.call_variants_batch_size,
+            scratch=args.scratch,
+            tmpfs_size=args.tmpfs_size,
+        )
+        
+        # Batch has no job dependencies, so run the stages back to back
+        for job_name, job_spec in stages:
+            result = submit_batch_job(
+                job_name=job_name,
+                job_spec=job_spec,
+                project_id=project_id,
+                region=args.region,
+                dry_run=args.dry_run,
+            )
+            if args.dry_run:
+                continue
+            if not result:
+                sys.exit(1)
+            state = wait_for_batch_job(job_name, project_id, args.region)
+            if state != "SUCCEEDED":
+                print(f"\n✗ {job_name} finished with state {state}")
+                sys.exit(1)
+        
+        if not args.dry_run:
+            print(f"\nResults available at:")
+            print(f"  VCF:  {output_vcf}")
+            print(f"  gVCF: {output_gvcf}")
+        return
+    
     # Create and submit job
     job_name, job_spec = create_deepvariant_batch_job(
         bam_path=args.bam,
@@ -309,6 +748,12 @@ Examples:
         model_type=args.model_type,
         num_shards=args.num_shards,
         use_spot=not args.no_spot,
+        transfer_threads=args.transfer_threads,
+        slice_size=args.slice_size,
+        stream_bam=args.stream_bam,
+        call_variants_batch_size=args.call_variants_batch_size,
+        scratch=args.scratch,
+        tmpfs_size=args.tmpfs_size,
     )
     
     result = submit_batch_job(
